@@ -4,6 +4,13 @@
 
 import os
 import json
+import fcntl
+import hashlib
+import contextlib
+import tempfile
+import threading
+import functools
+from concurrent import futures
 from dulwich import porcelain
 import requests
 
@@ -13,6 +20,16 @@ _COMMITTER = "cargo-packager <packaging@opensuse.org>"
 _CRATES_API = "https://crates.io/api/v1/crates"
 _INDEX_URL = "https://raw.githubusercontent.com/rust-lang/crates.io-index/master"
 
+_CHUNK_SIZE = 64 * 1024
+_INDEX_LOCK = ".cargo2rpm-lock"
+
+_local = threading.local()
+_http_cache = None
+_registry_db = None
+_sidecars = False
+_index_snapshot = None
+_index_source = None
+
 
 def index_for_crate(root, crate):
     clen = len(crate)
@@ -26,8 +43,129 @@ def index_for_crate(root, crate):
         return "/".join([root, crate[0:2], crate[2:4], crate])
 
 
+def index_files(root):
+    """
+    Yield (name, path) for every crate file in an index checkout
+    """
+    root = os.path.normpath(root)
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+        for fn in filenames:
+            if fn.startswith(".") or fn == "config.json":
+                continue
+            p = os.path.join(dirpath, fn)
+            if index_for_crate(root, fn) == p:
+                yield fn, p
+
+
+@contextlib.contextmanager
+def index_lock(root):
+    """
+    Hold the exclusive lock on a local index while rewriting
+    its files, so that concurrent writers don't lose updates
+    Not reentrant: don't nest it for the same root
+    """
+    fd = os.open(os.path.join(root, _INDEX_LOCK), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
+def cache_root(env, name):
+    """
+    The directory of a persistent cache: $env if set, else
+    name under $XDG_CACHE_HOME/cargo2rpm
+    env: the overriding variable, or None if there is none
+    """
+    root = os.environ.get(env) if env else None
+    if root:
+        return root
+    cache = os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
+    return os.path.join(cache, "cargo2rpm", name)
+
+
+@contextlib.contextmanager
+def atomic_file(path, mode="wb", prefix="tmp", perms=None):
+    """
+    Write path through a temporary file in the same directory,
+    renamed over it once the with block completes. On failure
+    the temporary file is removed and path is left untouched
+    perms: permissions to give the file (mkstemp makes it 0600)
+    """
+    fd, tmpname = tempfile.mkstemp(prefix=prefix, dir=os.path.dirname(path) or ".")
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+        if perms is not None:
+            os.chmod(tmpname, perms)
+        os.rename(tmpname, path)
+    except BaseException:
+        if os.path.exists(tmpname):
+            os.unlink(tmpname)
+        raise
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+def evict_lru(paths, max_size=None, max_entries=None, remove=_unlink):
+    """
+    Remove the least recently modified of paths until they take
+    up no more than max_size bytes and number no more than
+    max_entries. Paths that vanish meanwhile are skipped
+    remove: called to delete each evicted path
+    Returns (number removed, total size of what is left)
+    """
+    entries = []
+    for p in paths:
+        try:
+            st = os.stat(p)
+        except OSError:
+            continue
+        entries.append((st.st_mtime, st.st_size, p))
+    total = sum(size for mtime, size, p in entries)
+    left = len(entries)
+    entries.sort()
+    removed = 0
+    for mtime, size, p in entries:
+        if (max_size is None or total <= max_size) and (max_entries is None or left <= max_entries):
+            break
+        remove(p)
+        total -= size
+        left -= 1
+        removed += 1
+    return removed, total
+
+
+def write_index(indexfile, lines):
+    """
+    Atomically replace indexfile with lines
+    """
+    d = os.path.dirname(indexfile) or "."
+    if not os.path.isdir(d):
+        os.makedirs(d)
+    with atomic_file(indexfile, "w", prefix=".%s." % os.path.basename(indexfile), perms=0o644) as f:
+        f.write("".join(lines))
+
+
+def _use_sidecar(indexfile):
+    if _sidecars:
+        return True
+    from . import versionindex
+    return os.path.isfile(versionindex.sidecar_path(indexfile))
+
+
 def update_crate(indexfile, name, version, entry):
-    if os.path.isfile(indexfile):
+    if _use_sidecar(indexfile):
+        from . import versionindex
+        versionindex.update(indexfile, version, entry)
+    elif os.path.isfile(indexfile):
         found = False
         newindex = []
         with open(indexfile, "r") as f:
@@ -40,15 +178,18 @@ def update_crate(indexfile, name, version, entry):
                     newindex.append(line)
             if not found:
                 newindex.append("%s\n" % (entry))
-        with open(indexfile, "w") as f:
-            f.write("".join(newindex))
+        write_index(indexfile, newindex)
     else:
-        with open(indexfile, "w") as f:
-            f.write("%s\n" % (entry))
+        write_index(indexfile, ["%s\n" % (entry)])
+    if _registry_db is not None:
+        _registry_db.update(name, version, entry)
 
 
 def remove_crate(indexfile, name, version):
-    if os.path.isfile(indexfile):
+    if _use_sidecar(indexfile):
+        from . import versionindex
+        versionindex.remove(indexfile, version)
+    elif os.path.isfile(indexfile):
         found = False
         newindex = []
         with open(indexfile, "r") as f:
@@ -59,25 +200,146 @@ def remove_crate(indexfile, name, version):
                 else:
                     newindex.append(line)
         if found:
-            with open(indexfile, "w") as f:
-                f.write("".join(newindex))
+            write_index(indexfile, newindex)
+    if _registry_db is not None:
+        _registry_db.remove(name, version)
+
+
+def replace_crate(indexfile, name, lines):
+    """
+    Replace every version in indexfile with lines at once, keeping
+    its sidecar and the registry database in step like update_crate
+    """
+    sidecar = _use_sidecar(indexfile)
+    write_index(indexfile, lines)
+    if sidecar:
+        from . import versionindex
+        entries = []
+        offset = 0
+        for line in lines:
+            size = len(line.encode("utf-8"))
+            if line.strip():
+                entries.append((json.loads(line)["vers"], offset, size))
+            offset += size
+        versionindex.write_sidecar(indexfile, entries)
+    if _registry_db is not None:
+        _registry_db.replace(name, lines)
 
 
 def commit(root, indexfile, message=None):
+    """
+    Commit one index file, or a list of them, to the index repo
+    """
+    indexfiles = indexfile if isinstance(indexfile, list) else [indexfile]
     with porcelain.open_repo_closing(root) as repo:
-        porcelain.add(repo, indexfile)
+        porcelain.add(repo, indexfiles)
         if message is None:
-            message = "update %s" % (os.path.basename(indexfile))
+            message = "update %s" % (", ".join(os.path.basename(f) for f in indexfiles))
         porcelain.commit(repo, message=message, author=_AUTHOR, committer=_COMMITTER)
 
 
-def fetch_index_entry(name):
+def set_http_cache(cache):
+    """
+    Serve index and API requests through an HTTPCache,
+    or directly from the network if cache is None
+    """
+    global _http_cache
+    _http_cache = cache
+
+
+def http_cache():
+    return _http_cache
+
+
+def set_registry_db(db):
+    """
+    Keep a RegistryDB in sync with update_crate and remove_crate,
+    or stop doing so if db is None
+    """
+    global _registry_db
+    _registry_db = db
+
+
+def registry_db():
+    return _registry_db
+
+
+def set_index_source(source):
+    """
+    Fetch index files through source (such as a sparse.SparseIndex)
+    instead of from the crates.io-index repository on github
+    """
+    global _index_source
+    _index_source = source
+
+
+def index_source():
+    return _index_source
+
+
+def set_index_snapshot(snapshot):
+    """
+    Serve fetch_index_entry from a snapshot.Snapshot, going to
+    the network only for crates it doesn't contain, or when it
+    lacks a version the caller asked for (it may be older than
+    the crate's latest release)
+    """
+    global _index_snapshot
+    _index_snapshot = snapshot
+
+
+def index_snapshot():
+    return _index_snapshot
+
+
+def set_sidecars(enabled):
+    """
+    Create and use version offset sidecars for every index file
+    update_crate and remove_crate touch, not just those which
+    already have one
+    """
+    global _sidecars
+    _sidecars = enabled
+
+
+def index_entry(indexfile, version):
+    """
+    Return the line for version in a local index file, or None
+    """
+    if _use_sidecar(indexfile):
+        from . import versionindex
+        return versionindex.lookup(indexfile, version)
+    if not os.path.isfile(indexfile):
+        return None
+    with open(indexfile, "r") as f:
+        for line in f:
+            if line.strip() and json.loads(line)["vers"] == version:
+                return line
+    return None
+
+
+def _has_versions(data, versions):
+    found = set(json.loads(line)["vers"] for line in data.decode("utf-8").splitlines() if line.strip())
+    return found.issuperset(versions)
+
+
+def fetch_index_entry(name, versions=None):
     """
     Index entry downloader
     Fetches the json data for the crate from crates.io-index on github
+    versions: versions the caller needs, a snapshot that lacks any
+    of them is passed over
     """
+    if _index_snapshot is not None:
+        data = _index_snapshot.get(name)
+        if data is not None and (not versions or _has_versions(data, versions)):
+            return data
+    if _index_source is not None:
+        return _index_source.fetch(name)
     url = index_for_crate(_INDEX_URL, name)
-    r = requests.get(url)
+    if _http_cache is not None:
+        return _http_cache.get(session(), url)[0]
+    r = session().get(url)
     r.raise_for_status()
     return r.content
 
@@ -88,25 +350,335 @@ def fetch_crate_metadata(name):
     Generates metadata objects, one for each available version
     """
     url = "/".join([_CRATES_API, name])
-    r = requests.get(url)
+    if _http_cache is not None:
+        return json.loads(_http_cache.get(session(), url)[0])
+    r = session().get(url)
     r.raise_for_status()
     return r.json()
 
 
+def crate_url(name, version):
+    return "/".join([_CRATES_API, name, version, "download"])
+
+
 def crate_source_url(name, version):
     """
     Return the url of the crate
     """
-    url = "/".join([_CRATES_API, name, version, "download"])
-    r = requests.get(url, stream=True)
+    url = crate_url(name, version)
+    if _http_cache is not None:
+        return _http_cache.resolve(session(), url)
+    r = session().get(url, stream=True)
+    r.close()
     return r.url
 
 
+def session():
+    """
+    Return the HTTP session for the calling thread
+    Each download worker keeps its own pooled connections
+    """
+    s = getattr(_local, 'session', None)
+    if s is None:
+        s = requests.Session()
+        _local.session = s
+    return s
+
+
 def download_crate(name, version):
     """
     Download the crate tarball
     """
-    url = "/".join([_CRATES_API, name, version, "download"])
-    r = requests.get(url)
-    r.raise_for_status()
+    from . import download
+    r = download.get("/".join([_CRATES_API, name, version, "download"]))
     return r.content, r.url
+
+
+def index_cksum(name, version):
+    """
+    Return the sha256 checksum of a crate version
+    as recorded in its crates.io-index entry
+    """
+    for line in fetch_index_entry(name, [version]).splitlines():
+        e = json.loads(line)
+        if e.get("vers") == version:
+            return e["cksum"]
+    raise ValueError("%s %s not found in index" % (name, version))
+
+
+def _lock_part(part):
+    """
+    Open and exclusively lock the partial file part without
+    blocking. Returns the descriptor, or None if another process
+    is downloading to it
+    """
+    fd = os.open(part, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        # the holder we waited on may have renamed or removed it
+        if os.fstat(fd).st_ino == os.stat(part).st_ino:
+            return fd
+    except (IOError, OSError):
+        pass
+    os.close(fd)
+    return None
+
+
+def download_crate_to(name, version, fname, cksum=None):
+    """
+    Download the crate tarball to fname
+    The data goes to a partial file next to fname, which is kept
+    to resume from if the download fails, and is only renamed into
+    place once its sha256 matches cksum. The partial file is locked
+    for the whole transfer; if another process holds it, this one
+    downloads to a private temporary file instead
+    Returns the url the crate was downloaded from
+    """
+    from . import download
+    if cksum is None:
+        cksum = index_cksum(name, version)
+    d = os.path.dirname(fname) or "."
+    part = os.path.join(d, ".%s.part" % os.path.basename(fname))
+    lockfd = _lock_part(part)
+    if lockfd is None:
+        fd, part = tempfile.mkstemp(prefix=".%s." % os.path.basename(fname), dir=d)
+        os.close(fd)
+    try:
+        try:
+            url = download.fetch_to(crate_url(name, version), part)
+        except BaseException:
+            if lockfd is None:
+                os.unlink(part)
+            raise
+        h = hashlib.sha256()
+        with open(part, "rb") as f:
+            for chunk in iter(lambda: f.read(_CHUNK_SIZE), b""):
+                h.update(chunk)
+        if h.hexdigest() != cksum:
+            os.unlink(part)
+            raise ValueError("checksum mismatch for %s %s: expected %s, got %s" %
+                             (name, version, cksum, h.hexdigest()))
+        os.chmod(part, 0o644)
+        os.rename(part, fname)
+        return url
+    finally:
+        if lockfd is not None:
+            os.close(lockfd)
+
+
+def lock_checksum(lock, pkg):
+    """
+    Return the checksum Cargo.lock records for a package, if any
+    Handles both the per-package field and the old [metadata] table
+    """
+    cksum = pkg.get('checksum')
+    if cksum is None and 'source' in pkg:
+        key = 'checksum %s %s (%s)' % (pkg['name'], pkg['version'], pkg['source'])
+        cksum = lock.get('metadata', {}).get(key)
+    return cksum
+
+
+def fetch_crate(name, version, fname, cksum=None, store=None):
+    """
+    Place the crate tarball at fname
+    With a CrateStore, the crate is linked from the store,
+    downloading it into the store first if needed
+    Returns the source url of the crate
+    """
+    if store is None:
+        print("Downloading %s %s to %s..." % (name, version, fname))
+        return download_crate_to(name, version, fname, cksum)
+    if cksum is None:
+        cksum = index_cksum(name, version)
+    if store.link(cksum, fname):
+        print("Linking %s %s to %s..." % (name, version, fname))
+        return crate_url(name, version)
+    print("Downloading %s %s to %s..." % (name, version, fname))
+    url = download_crate_to(name, version, store.prepare(cksum), cksum)
+    store.link(cksum, fname)
+    return url
+
+
+def _fetch_one(store, crate):
+    name, version, fname, cksum = crate
+    return fetch_crate(name, version, fname, cksum, store)
+
+
+def fetch_crates(crates, jobs=1, store=None):
+    """
+    Download many crates concurrently
+    crates is a list of (name, version, filename, cksum) tuples,
+    cksum may be None to look it up in the index
+    Returns the source urls in the same order as crates
+    """
+    fetch = functools.partial(_fetch_one, store)
+    if jobs <= 1 or len(crates) <= 1:
+        return [fetch(c) for c in crates]
+    with futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        return list(pool.map(fetch, crates))
+
+
+class _StubResponse(object):
+    def __init__(self, url, data):
+        self.url = url
+        self.status_code = 200
+        self.headers = {}
+        self.content = data
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, size):
+        return [self.content[i:i + size] for i in range(0, len(self.content), size)]
+
+    def close(self):
+        pass
+
+
+class _StubSession(object):
+    """
+    Stands in for the session of a thread, serving data[url]
+    """
+    def __init__(self, data):
+        self.data = data
+        self.urls = []
+
+    def get(self, url, **kwargs):
+        self.urls.append(url)
+        return _StubResponse(url, self.data[url])
+
+
+def test_download_crate_to_busy_part():
+    import shutil
+    root = tempfile.mkdtemp()
+    data = b"crate data"
+    _local.session = _StubSession({crate_url("libc", "0.2.0"): data})
+    try:
+        fname = os.path.join(root, "libc-0.2.0.crate")
+        part = os.path.join(root, ".libc-0.2.0.crate.part")
+        # another download holds the partial file
+        held = _lock_part(part)
+        assert held is not None and _lock_part(part) is None
+        cksum = hashlib.sha256(data).hexdigest()
+        download_crate_to("libc", "0.2.0", fname, cksum)
+        with open(fname, "rb") as f:
+            assert f.read() == data
+        assert os.path.getsize(part) == 0
+        assert sorted(os.listdir(root)) == [".libc-0.2.0.crate.part", "libc-0.2.0.crate"]
+        os.close(held)
+    finally:
+        _local.session = None
+        shutil.rmtree(root)
+
+
+def test_index_files():
+    import shutil
+    root = tempfile.mkdtemp()
+    try:
+        for name in ["a", "ab", "abc", "serde"]:
+            write_index(index_for_crate(root, name), ["{}\n"])
+        write_index(os.path.join(root, "config.json"), ["{}\n"])
+        write_index(os.path.join(root, "se", "rd", "stray"), ["{}\n"])
+        names = sorted(name for name, p in index_files(root))
+        assert names == ["a", "ab", "abc", "serde"]
+        assert sorted(name for name, p in index_files(root + "/")) == names
+    finally:
+        shutil.rmtree(root)
+
+
+def test_cache_helpers():
+    import shutil
+    root = tempfile.mkdtemp()
+    saved = dict(os.environ)
+    try:
+        os.environ["XDG_CACHE_HOME"] = root
+        os.environ.pop("CARGO2RPM_TEST_CACHE", None)
+        assert cache_root("CARGO2RPM_TEST_CACHE", "test") == os.path.join(root, "cargo2rpm", "test")
+        os.environ["CARGO2RPM_TEST_CACHE"] = "/elsewhere"
+        assert cache_root("CARGO2RPM_TEST_CACHE", "test") == "/elsewhere"
+
+        paths = []
+        for i in range(4):
+            p = os.path.join(root, "entry%d" % i)
+            with atomic_file(p) as f:
+                f.write(b"x" * 10)
+            os.utime(p, (i, i))
+            paths.append(p)
+        try:
+            with atomic_file(paths[0]) as f:
+                f.write(b"partial")
+                raise ValueError
+        except ValueError:
+            pass
+        assert sorted(os.listdir(root)) == ["entry0", "entry1", "entry2", "entry3"]
+        with open(paths[0], "rb") as f:
+            assert f.read() == b"x" * 10
+
+        assert evict_lru(paths + [os.path.join(root, "gone")], max_entries=3) == (1, 30)
+        assert not os.path.exists(paths[0])
+        assert evict_lru(paths, max_size=15) == (2, 10)
+        assert os.listdir(root) == ["entry3"]
+        assert evict_lru(paths, max_size=10, max_entries=1) == (0, 10)
+    finally:
+        os.environ.clear()
+        os.environ.update(saved)
+        shutil.rmtree(root)
+
+
+def test_download_crate_to_mismatch():
+    import shutil
+    root = tempfile.mkdtemp()
+    _local.session = _StubSession({crate_url("libc", "0.2.0"): b"tampered"})
+    try:
+        fname = os.path.join(root, "libc-0.2.0.crate")
+        cksum = hashlib.sha256(b"crate data").hexdigest()
+        part = os.path.join(root, ".libc-0.2.0.crate.part")
+        for busy in (False, True):
+            held = _lock_part(part) if busy else None
+            try:
+                download_crate_to("libc", "0.2.0", fname, cksum)
+                assert False
+            except ValueError as e:
+                assert "checksum mismatch" in str(e)
+            # nothing is renamed into place, and neither the partial
+            # file nor a private temporary one is left behind
+            assert os.listdir(root) == ([os.path.basename(part)] if busy else [])
+            assert not busy or os.path.getsize(part) == 0
+            if held is not None:
+                os.close(held)
+    finally:
+        _local.session = None
+        shutil.rmtree(root)
+
+
+def test_fetch_crates_order():
+    import shutil
+    from . import download
+    root = tempfile.mkdtemp()
+    names = ["a", "b", "c"]
+    data = dict((crate_url(n, "1.0.0"), n.encode("utf-8")) for n in names)
+    last_fetched = threading.Event()
+
+    class Session(_StubSession):
+        def get(self, url, **kwargs):
+            # the first crate only finishes after the last one
+            if url == crate_url("a", "1.0.0"):
+                assert last_fetched.wait(5)
+            r = _StubSession.get(self, url, **kwargs)
+            if url == crate_url("c", "1.0.0"):
+                last_fetched.set()
+            return r
+
+    stub = Session(data)
+    download.session = lambda: stub
+    try:
+        crates = [(n, "1.0.0", os.path.join(root, "%s.crate" % (n)), hashlib.sha256(n.encode("utf-8")).hexdigest())
+                  for n in names]
+        assert fetch_crates(crates, jobs=3) == [crate_url(n, "1.0.0") for n in names]
+        assert stub.urls.index(crate_url("a", "1.0.0")) > stub.urls.index(crate_url("c", "1.0.0"))
+        for n in names:
+            with open(os.path.join(root, "%s.crate" % (n)), "rb") as f:
+                assert f.read() == n.encode("utf-8")
+    finally:
+        download.session = session
+        shutil.rmtree(root)
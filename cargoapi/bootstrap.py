@@ -2,17 +2,27 @@ from __future__ import print_function
 import os
 import re
 import sys
+import time
+import threading
 import subprocess
+import shutil
 import tarfile
+import tempfile
+from collections import OrderedDict, deque
+from concurrent import futures
 import pytoml as toml
 from . import semver
+from . import lock_checksum
+from .manifestcache import manifest_key, ManifestCache
+from . import fingerprint
+from .timings import Timings
 
 BSCRIPT = re.compile(r'^cargo:(?P<key>([^\s=]+))(=(?P<value>.+))?$')
 BNAME = re.compile('^(lib)?(?P<name>([^_]+))(_.*)?$')
-
+LOCKDEP = re.compile(r'(\S+)\s+(\S+)(?:\s+\((.+)\))?')
 
 class CrateInfo(object):
-    def __init__(self, target, cdir, cfg):
+    def __init__(self, target, cdir, cfg, isfile=os.path.isfile):
         self.name = None
         self.version = None
         self.deps = []
@@ -124,7 +134,7 @@ class CrateInfo(object):
 
             found_path = None
             for p in bin_paths:
-                if os.path.isfile(p):
+                if isfile(p):
                     found_path = p
                     break
 
@@ -137,7 +147,7 @@ class CrateInfo(object):
         d.update(cfg.get('dependencies', {}))
         d.update(cfg.get('target', {}).get(target, {}).get('dependencies', {}))
         deps = []
-        for k, v in d.iteritems():
+        for k, v in d.items():
             newdep = None
             if type(v) is not dict:
                 newdep = {'name': k, 'req': v}
@@ -166,8 +176,52 @@ class CrateInfo(object):
         self.deps = deps
         self.build = build
 
+    def to_dict(self):
+        return {'name': self.name, 'version': self.version, 'deps': self.deps,
+                'build': self.build, 'features': self.features}
+
+    @classmethod
+    def from_dict(cls, d):
+        info = cls.__new__(cls)
+        info.name = d['name']
+        info.version = d['version']
+        info.deps = d['deps']
+        info.build = d['build']
+        info.features = d['features']
+        return info
+
+
+_manifest_cache = None
+
+
+def set_manifest_cache(cache):
+    """
+    Reuse parsed manifests from a ManifestCache,
+    or parse every time if cache is None
+    """
+    global _manifest_cache
+    _manifest_cache = cache
+
 
 def crate_info_from_toml(target, cdir):
+    if _manifest_cache is None:
+        return parse_crate_info(target, cdir)
+    key = manifest_key(target, cdir)
+    if key is None:
+        return parse_crate_info(target, cdir)
+    cached = _manifest_cache.get(key)
+    if cached is not None:
+        return CrateInfo.from_dict(cached)
+    info = parse_crate_info(target, cdir)
+    _manifest_cache.put(key, info.to_dict())
+    return info
+
+
+def parse_crate_info(target, cdir, manifest=None, isfile=os.path.isfile):
+    """
+    Parse the Cargo.toml in cdir, or the given manifest text
+    isfile decides which build target paths exist
+    """
     if 'url-0.5.7' in cdir:
         url_057_toml = '''[package]
 
@@ -202,10 +256,53 @@ unicode-normalization = "0.1.2"
 matches = "0.1"
 '''
         cfg = toml.loads(url_057_toml)
+    elif manifest is not None:
+        cfg = toml.loads(manifest)
     else:
         ctoml = open(os.path.join(cdir, 'Cargo.toml'), 'rb')
         cfg = toml.load(ctoml)
-    return CrateInfo(target, cdir, cfg)
+    return CrateInfo(target, cdir, cfg, isfile)
+
+
+def read_crate_manifest(cfp, namever):
+    """
+    Stream a .crate and return its Cargo.toml along with the set of
+    files it contains, relative to the unpack dir, without unpacking
+    """
+    manifest = None
+    files = set()
+    with tarfile.open(cfp, 'r|gz') as tf:
+        for member in tf:
+            if not member.isfile():
+                continue
+            files.add(os.path.normpath(member.name))
+            if member.name == '%s/Cargo.toml' % (namever):
+                manifest = tf.extractfile(member).read().decode('utf-8')
+    if manifest is None:
+        raise RuntimeError('no Cargo.toml in %s' % (cfp))
+    return manifest, files
+
+
+def lazy_crate_info(target, cache, namever):
+    """
+    Parse the manifest of cache/namever.crate without unpacking it
+    The returned CrateInfo points at cache/namever, where the
+    crate will be unpacked if it ends up being built
+    """
+    cfp = os.path.join(cache, '%s.crate' % (namever))
+    cdir = os.path.join(cache, namever)
+    key = None
+    if _manifest_cache is not None:
+        key = manifest_key(target, cdir, cfp)
+        cached = _manifest_cache.get(key) if key is not None else None
+        if cached is not None:
+            return CrateInfo.from_dict(cached)
+    manifest, files = read_crate_manifest(cfp, namever)
+    info = parse_crate_info(target, cdir, manifest,
+                            lambda p: os.path.relpath(p, cache) in files)
+    if key is not None:
+        _manifest_cache.put(key, info.to_dict())
+    return info
 
 def lock_info(cdir):
     with open(os.path.join(cdir, 'Cargo.lock'), 'rb') as lockfile:
@@ -221,44 +318,184 @@ def dbg(str):
     print(str)
 
 
+def extract_crate(cfp, dest, namever):
+    """
+    Unpack a .crate into dest/namever
+    Members are checked for path traversal as they are extracted,
+    in a single pass over the archive. The crate is unpacked into a
+    temporary directory first, so a partial unpack is never seen.
+    """
+    final = os.path.join(dest, namever)
+    tmp = tempfile.mkdtemp(prefix='.%s.' % (namever), dir=dest)
+    try:
+        abs_tmp = os.path.abspath(tmp)
+        with tarfile.open(cfp, 'r|gz') as tf:
+            for member in tf:
+                member_path = os.path.abspath(os.path.join(tmp, member.name))
+                if os.path.commonprefix([abs_tmp + os.sep, member_path]) != abs_tmp + os.sep:
+                    raise Exception("Attempted Path Traversal in Tar File")
+                tf.extract(member, tmp)
+        try:
+            os.rename(os.path.join(tmp, namever), final)
+        except OSError:
+            # someone else unpacked it first
+            if not os.path.isdir(final):
+                raise
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return final
+
+
+def _prefetch(cache, target, namever, manifest_root, lazy):
+    # runs in a worker process: unpack and parse one crate
+    cratedir = os.path.join(cache, namever)
+    if lazy and not os.path.isdir(cratedir):
+        cfp = os.path.join(cache, '%s.crate' % (namever))
+        manifest, files = read_crate_manifest(cfp, namever)
+        info = parse_crate_info(target, cratedir, manifest,
+                                lambda p: os.path.relpath(p, cache) in files).to_dict()
+        key = manifest_key(target, cratedir, cfp)
+    else:
+        if not os.path.isdir(cratedir):
+            extract_crate(os.path.join(cache, '%s.crate' % (namever)), cache, namever)
+        info = parse_crate_info(target, cratedir).to_dict()
+        key = manifest_key(target, cratedir)
+    if manifest_root is not None:
+        if key is not None:
+            ManifestCache(manifest_root).put(key, info)
+    return cratedir, info
+
+
+def start_prefetch(jobs):
+    """
+    Start unpacking and parsing every locked crate in a process
+    pool, so the resolver only has to pick up the results
+    """
+    pool = futures.ProcessPoolExecutor(max_workers=jobs)
+    manifest_root = _manifest_cache.root if _manifest_cache is not None else None
+    for (name, version), lock in Crate.LOCKS.items():
+        namever = '%s-%s' % (name, version)
+        cratedir = os.path.join(Crate.CACHE, namever)
+        cfp = os.path.join(Crate.CACHE, '%s.crate' % (namever))
+        if _manifest_cache is not None:
+            if os.path.isdir(cratedir):
+                key = manifest_key(Crate.TARGET, cratedir)
+            else:
+                key = manifest_key(Crate.TARGET, cratedir, cfp)
+            if key is not None and _manifest_cache.get(key) is not None:
+                continue
+        if not os.path.isfile(cfp) and Crate.STORE is not None:
+            Crate.link_from_store(name, version, cfp)
+        if os.path.isdir(cratedir) or os.path.isfile(cfp):
+            Crate.PREFETCH[namever] = pool.submit(_prefetch, Crate.CACHE, Crate.TARGET, namever,
+                                                  manifest_root, Crate.LAZY)
+    return pool
+
+
+def stop_prefetch(pool):
+    for f in Crate.PREFETCH.values():
+        f.cancel()
+    pool.shutdown(wait=True)
+    Crate.PREFETCH = {}
+
+
 class Runner(object):
-    def __init__(self, c, e, cwd=None):
+    """
+    Runs a command, streaming its output line by line
+    Only the last few lines are kept in stdout/stderr, the full
+    output goes to the log file if one is given. stderr is echoed
+    live, prefixed with prefix.
+    """
+    TAIL = 50
+
+    def __init__(self, c, e, cwd=None, log=None, prefix=None):
         self._cmd = c
         if not isinstance(self._cmd, list):
             self._cmd = [self._cmd]
         self._env = e
-        self.stdout = []
-        self.stderr = []
+        self.stdout = deque(maxlen=Runner.TAIL)
+        self.stderr = deque(maxlen=Runner.TAIL)
         self.returncode = 0
         self.cwd = cwd
+        self.log = log
+        self.prefix = prefix
+        self.started = None
+        self.ended = None
+        self.cpu = 0.0
+        self.maxrss = 0
+
+    def line(self, l):
+        """
+        Called for each non-empty line of stdout as it arrives
+        """
+        pass
+
+    def _read(self, pipe, tail, logf, lock, echo):
+        for raw in iter(pipe.readline, b''):
+            l = raw.decode('utf-8', 'replace').rstrip('\n')
+            if logf is not None:
+                with lock:
+                    logf.write(l + '\n')
+            if len(l) == 0:
+                continue
+            tail.append(l)
+            if echo:
+                if self.prefix is not None:
+                    sys.stderr.write('[%s] %s\n' % (self.prefix, l))
+                else:
+                    sys.stderr.write(l + '\n')
+            else:
+                self.line(l)
+        pipe.close()
+
+    def _wait(self, proc):
+        # wait4 gives us the resource usage of this child alone
+        if not hasattr(os, 'wait4'):
+            returncode = proc.wait()
+            self.ended = time.time()
+            return returncode
+        _, status, usage = os.wait4(proc.pid, 0)
+        self.ended = time.time()
+        self.cpu = usage.ru_utime + usage.ru_stime
+        self.maxrss = usage.ru_maxrss
+        if os.WIFSIGNALED(status):
+            proc.returncode = -os.WTERMSIG(status)
+        else:
+            proc.returncode = os.WEXITSTATUS(status)
+        return proc.returncode
 
     def __call__(self, c, e):
         cmd = self._cmd + c
         env = dict(self._env, **e)
         envstr = ''
-        for k, v in env.iteritems():
+        for k, v in env.items():
             envstr += ' %s="%s"' % (k, v)
         if self.cwd is not None:
             dbg('cd %s && %s %s' % (self.cwd, envstr, ' '.join(cmd)))
         else:
             dbg('%s %s' % (envstr, ' '.join(cmd)))
 
-        proc = subprocess.Popen(cmd, env=env,
-                                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                                cwd=self.cwd)
-        out, err = proc.communicate()
-
-        for lo in out.split('\n'):
-            if len(lo) > 0:
-                self.stdout.append(lo)
-
-        for le in err.split('\n'):
-            if len(le) > 0:
-                self.stderr.append(le)
-                dbg(le)
-
-        self.returncode = proc.wait()
-        return self.stdout
+        self.stdout = deque(maxlen=Runner.TAIL)
+        self.stderr = deque(maxlen=Runner.TAIL)
+        self.started = time.time()
+        logf = open(self.log, 'a') if self.log is not None else None
+        lock = threading.Lock()
+        try:
+            if logf is not None:
+                logf.write('$ %s\n' % (' '.join(cmd)))
+            proc = subprocess.Popen(cmd, env=env,
+                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                    cwd=self.cwd)
+            errthread = threading.Thread(target=self._read,
+                                         args=(proc.stderr, self.stderr, logf, lock, True))
+            errthread.start()
+            self._read(proc.stdout, self.stdout, logf, lock, False)
+            errthread.join()
+            self.returncode = self._wait(proc)
+        finally:
+            if logf is not None:
+                logf.close()
+        return list(self.stdout)
 
 
 class RustcRunner(Runner):
@@ -269,43 +506,73 @@ class RustcRunner(Runner):
 
 class BuildScriptRunner(Runner):
     def __call__(self, c, e):
+        self._out = ([], {}, {})
+        self.rerun_sources = []
+        self.rerun_envs = []
         super(BuildScriptRunner, self).__call__(c, e)
+        return self._out
 
-        # parse the output for cargo: lines
-        cmd = []
-        env = {}
-        denv = {}
-        for l in self.stdout:
-            match = BSCRIPT.match(str(l))
-            if match is None:
-                continue
-            pieces = match.groupdict()
-            k = pieces['key']
-            v = pieces['value']
-
-            if k == 'rustc-link-lib':
-                cmd += ['-l', v]
-            elif k == 'rustc-link-search':
-                cmd += ['-L', v]
-            elif k == 'rustc-cfg':
-                cmd += ['--cfg', v]
-                env['CARGO_FEATURE_%s' % v.upper().replace('-', '_')] = 1
-            else:
-                denv[k] = v
-        return (cmd, env, denv)
+    def line(self, l):
+        # parse cargo: lines as they are printed
+        match = BSCRIPT.match(str(l))
+        if match is None:
+            return
+        cmd, env, denv = self._out
+        pieces = match.groupdict()
+        k = pieces['key']
+        v = pieces['value']
+
+        if k == 'rustc-link-lib':
+            cmd += ['-l', v]
+        elif k == 'rustc-link-search':
+            cmd += ['-L', v]
+        elif k == 'rustc-cfg':
+            cmd += ['--cfg', v]
+            env['CARGO_FEATURE_%s' % v.upper().replace('-', '_')] = '1'
+        else:
+            denv[k] = v
+            if v is not None and k == 'rerun-if-changed':
+                self.rerun_sources.append(os.path.join(self.cwd or '.', v))
+            elif v is not None and k == 'rerun-if-env-changed':
+                self.rerun_envs.append(v)
+
+
+class CachedRunner(object):
+    """
+    Stands in for a BuildScriptRunner whose result was cached
+    """
+    def __init__(self, result):
+        self.result = tuple(result)
+        self.stdout = []
+        self.stderr = []
+        self.returncode = 0
+
+    def __call__(self, c, e):
+        return self.result
 
 
 class Crate(object):
     TARGET = None
     HOST = None
     CACHE = None
+    STORE = None
+    LAZY = False
+    PREFETCH = {}
+    SCRIPT_CACHE = None
+    TIMINGS = None
+    LOCK = {}
     BLACKLIST = []
     OPTIONALS = []
-    PACKAGES = []
-    UNRESOLVED = []
+    LOCKS = {}
+    UNRESOLVED = deque()
+    QUEUED = {}
     CRATES = {}
     BUILT = {}
 
+    __slots__ = ('name', 'version', 'crateinfo', '_dir', '_dep_env', '_dep_info',
+                 '_builddeps', '_resolved', '_build', '_env', '_extra_flags',
+                 '_lock', '_deps', '_fingerprint')
+
     def __init__(self, name, ver, crateinfo, cdir, build, dep_info):
         self.name = name
         self.version = ver
@@ -321,31 +588,34 @@ class Crate(object):
         self._build += [x for x in build if x.get('type') == 'bin']
         self._env = {}
         self._extra_flags = []
+        self._fingerprint = None
 
-        for lock in Crate.PACKAGES:
-            if lock['name'] == name and lock['version'] == ver:
-                self._lock = lock
-                break
-        else:
+        self._lock = Crate.LOCKS.get((name, ver))
+        if self._lock is None:
             raise ValueError("No lock data for %s-%s" % (name, ver))
 
+        by_name = {}
+        for dep in dep_info:
+            by_name.setdefault(dep['name'], []).append(dep)
+
         self._deps = []
-        dstr = re.compile(r'(\S+)\s+(\S+)(?:\s+\((.+)\))?')
         for ldep in self._lock.get('dependencies', []):
-            m = dstr.match(ldep)
+            m = LOCKDEP.match(ldep)
             if not m:
                 raise ValueError("Failed to parse dependency for %s: %s" % (name, ldep))
             ldep_name = m.group(1)
             ldep_ver = m.group(2)
-            for dep in dep_info:
-                if dep['name'] != ldep_name:
-                    continue
-                req = semver.SemverRange(dep['req'])
-                if req.compare(ldep_ver):
+            for dep in by_name.get(ldep_name, []):
+                if semver.semver_range(dep['req']).compare(ldep_ver):
                     ndep = {'version': ldep_ver}
                     ndep.update(dep)
                     self._deps.append(ndep)
 
+    @staticmethod
+    def queue(crate):
+        Crate.QUEUED[crate.namever()] = crate
+        Crate.UNRESOLVED.append(crate)
+
     def namever(self):
         return "%s-%s" % (self.name, self.version)
 
@@ -355,31 +625,42 @@ class Crate(object):
             return os.path.join(Crate.CACHE, namever)
         else:
             cfp = os.path.join(Crate.CACHE, '%s.crate' % (namever))
-            with tarfile.open(cfp) as tf:
-                dbg('unpacking %s.crate to %s...' % (namever, Crate.CACHE))
-                def is_within_directory(directory, target):
-                    
-                    abs_directory = os.path.abspath(directory)
-                    abs_target = os.path.abspath(target)
-                
-                    prefix = os.path.commonprefix([abs_directory, abs_target])
-                    
-                    return prefix == abs_directory
-                
-                def safe_extract(tar, path=".", members=None, *, numeric_owner=False):
-                
-                    for member in tar.getmembers():
-                        member_path = os.path.join(path, member.name)
-                        if not is_within_directory(path, member_path):
-                            raise Exception("Attempted Path Traversal in Tar File")
-                
-                    tar.extractall(path, members, numeric_owner=numeric_owner) 
-                    
-                
-                safe_extract(tf, path=Crate.CACHE)
-            return os.path.join(Crate.CACHE, namever)
+            if not os.path.isfile(cfp) and Crate.STORE is not None:
+                Crate.link_from_store(name, version, cfp)
+            dbg('unpacking %s.crate to %s...' % (namever, Crate.CACHE))
+            return extract_crate(cfp, Crate.CACHE, namever)
         return None
 
+    @staticmethod
+    def link_from_store(name, version, cfp):
+        lock = Crate.LOCKS.get((name, version))
+        if lock is not None:
+            cksum = lock_checksum(Crate.LOCK, lock)
+            if cksum is not None and Crate.STORE.link(cksum, cfp):
+                dbg('linked %s-%s.crate from %s' % (name, version, Crate.STORE.root))
+
+    def load_dep(self, name, version):
+        """
+        Return the unpacked directory and CrateInfo of a dependency,
+        using the prefetched result if there is one
+        """
+        future = Crate.PREFETCH.get('%s-%s' % (name, version))
+        if future is not None:
+            try:
+                cratedir, info = future.result()
+                return cratedir, CrateInfo.from_dict(info)
+            except Exception as e:
+                dbg('prefetching %s-%s failed: %s' % (name, version, e))
+        namever = '%s-%s' % (name, version)
+        cratedir = os.path.join(Crate.CACHE, namever)
+        if Crate.LAZY and not os.path.isdir(cratedir):
+            cfp = os.path.join(Crate.CACHE, '%s.crate' % (namever))
+            if not os.path.isfile(cfp) and Crate.STORE is not None:
+                Crate.link_from_store(name, version, cfp)
+            return cratedir, lazy_crate_info(Crate.TARGET, Crate.CACHE, namever)
+        cratedir = self.unpack_crate(name, version)
+        return cratedir, crate_info_from_toml(Crate.TARGET, cratedir)
+
     def build_dep(self, namever, info, out_dir):
         print("Build", namever)
         crate = Crate.CRATES[namever]
@@ -404,8 +685,7 @@ class Crate(object):
                 name, version = d['name'], d['version']
                 dbg('Looking up info for %s: %s' % (name, d))
                 if not d.get('local', False):
-                    cratedir = self.unpack_crate(name, version)
-                    crateinfo = crate_info_from_toml(Crate.TARGET, cratedir)
+                    cratedir, crateinfo = self.load_dep(name, version)
                     name = crateinfo.name
                     deps += crateinfo.deps
                     build = crateinfo.build
@@ -424,15 +704,15 @@ class Crate(object):
                     dbg('Skipping optional dep %s for %s' % (d['name'], self.namever()))
                     continue
 
-                dcrate = Crate(name, version, crateinfo, cratedir, build, deps)
-                if dcrate.namever() in Crate.CRATES:
-                    dcrate = Crate.CRATES[dcrate.namever()]
-                Crate.UNRESOLVED.append(dcrate)
+                dcrate = Crate.QUEUED.get('%s-%s' % (name, version))
+                if dcrate is None:
+                    dcrate = Crate(name, version, crateinfo, cratedir, build, deps)
+                    Crate.queue(dcrate)
 
                 # clean up the list of features that are enabled
                 tftrs = d.get('features', [])
                 if isinstance(tftrs, dict):
-                    tftrs = tftrs.keys()
+                    tftrs = list(tftrs.keys())
                 else:
                     tftrs = [x for x in tftrs if len(x) > 0]
 
@@ -475,29 +755,78 @@ class Crate(object):
             return
         self._builddeps[namever] = {'features': [str(x) for x in features]}
 
+    def rlib(self, out_dir):
+        return os.path.join(out_dir, 'lib%s-%s.rlib' % (flatdash(self.name), self.version.replace('.', '_')))
+
     def build(self, by, out_dir, features=[]):
-        output_name = flatdash(self.name)
-        extra_filename = '-%s' % (self.version.replace('.', '_'))
-        output_name = os.path.join(out_dir, 'lib%s%s.rlib' % (flatdash(self.name), extra_filename))
+        output_name = self.rlib(out_dir)
         if self.namever() in Crate.BUILT:
             return ({'name': self.name, 'lib': output_name}, self._env, self._extra_flags)
 
         externs = []
 
-        for dep, info in self._builddeps.iteritems():
+        for dep, info in self._builddeps.items():
             extern = self.build_dep(dep, info, out_dir)
             externs.append(extern)
 
-        if os.path.isfile(output_name):
-            print('Skipping %s, already built (needed by: %s)' % (self.namever(), str(by)))
-            Crate.BUILT[self.namever()] = by
-            return ({'name': self.name, 'lib': output_name}, self._env, self._extra_flags)
+        return self.compile(by, out_dir, features, externs)
+
+    def plan(self, by, features, order):
+        """
+        Walk the dependencies in the same order as build, recording
+        which crate first needs each one and with which features
+        """
+        if self.namever() in order:
+            return
+        order[self.namever()] = (by, features)
+        for dep, info in self._builddeps.items():
+            Crate.CRATES[dep].plan(self.namever(), info.get('features', []), order)
+
+    def script_out_dir(self, out_dir):
+        return os.path.join(out_dir, 'build', self.namever(), 'out')
+
+    def use_cached_scripts(self, cmds, script_out):
+        """
+        Replace build scripts with unchanged inputs by their cached
+        results, dropping the rustc invocation that builds them
+        """
+        cached = set()
+        for c in cmds:
+            if 'script_key' not in c:
+                continue
+            result = Crate.SCRIPT_CACHE.lookup(c['script_key'])
+            if result is not None and Crate.SCRIPT_CACHE.restore(c['script_key'], script_out):
+                dbg('Using cached build script output for %s' % (self.namever()))
+                c['cmd'] = CachedRunner(result)
+                # already cached, nothing to store after running it
+                del c['script_key']
+                cached.add(c['name'])
+        return [c for c in cmds if not (c.get('script_build') and c['name'] in cached)]
+
+    def cache_script(self, c, result, script_out):
+        runner = c['cmd']
+        sources = list(runner.rerun_sources)
+        if os.path.isfile(c['depinfo_script']):
+            sources += fingerprint.parse_dep_info(c['depinfo_script'])
+        Crate.SCRIPT_CACHE.store(c['script_key'], result, sources, runner.rerun_envs, script_out)
+
+    def compile(self, by, out_dir, features, externs):
+        """
+        Run rustc and the build script for this crate alone,
+        its dependencies must already be built
+        """
+        output_name = self.rlib(out_dir)
+        extra_filename = '-%s' % (self.version.replace('.', '_'))
+
+        if not os.path.isdir(self._dir):
+            # resolved lazily, unpack it now that it is being built
+            self.unpack_crate(self.name, self.version)
 
         # build the environment for subcommands
         tenv = dict(os.environ)
         env = {}
         env['PATH'] = tenv['PATH']
-        env['OUT_DIR'] = out_dir
+        env['OUT_DIR'] = self.script_out_dir(out_dir)
         env['TARGET'] = Crate.TARGET
         env['HOST'] = Crate.HOST
         env['NUM_JOBS'] = '1'
@@ -513,11 +842,17 @@ class Crate(object):
         env['CARGO_PKG_VERSION'] = self.version
         for f in features:
             env['CARGO_FEATURE_%s' % f.upper().replace('-', '_')] = '1'
-        for l, e in self._dep_env.iteritems():
-            for k, v in e.iteritems():
-                if type(v) is not str and type(v) is not unicode:
+        for l, e in self._dep_env.items():
+            for k, v in e.items():
+                if not isinstance(v, str):
                     v = str(v)
                 env['DEP_%s_%s' % (l.upper(), v.upper())] = v
+        deps = [Crate.CRATES[dep]._fingerprint for dep in self._builddeps]
+        if not os.path.isdir(env['OUT_DIR']):
+            os.makedirs(env['OUT_DIR'])
+
+        log = os.path.join(os.path.dirname(env['OUT_DIR']), 'output.log')
+
         # create the builders, build scripts are first
         cmds = []
         for b in self._build:
@@ -577,15 +912,42 @@ class Crate(object):
                 match = match.groupdict()['name'].replace('-', '_')
 
             # queue up the runner
-            cmds.append({'name': b['name'], 'env_key': match, 'cmd': RustcRunner(cmd, env)})
+            depinfo = os.path.join(out_dir, '%s%s.d' % (cmd[cmd.index('--crate-name') + 1], extra_filename))
+            cmds.append({'name': b['name'], 'env_key': match, 'cmd': RustcRunner(cmd, env, log=log, prefix=self.namever()),
+                         'depinfo': depinfo,
+                         'script_build': b['type'] == 'build_script'})
 
             # queue up the build script runner
             if b['type'] == 'build_script':
                 bcmd = os.path.join(out_dir, 'build_script_%s-%s' % (b['name'], v))
-                cmds.append({'name': b['name'], 'env_key': match, 'cmd': BuildScriptRunner(bcmd, env, self._dir)})
+                script_key = fingerprint.digest({'cmd': cmd, 'env': env, 'features': features, 'deps': deps})
+                cmds.append({'name': b['name'], 'env_key': match, 'cmd': BuildScriptRunner(bcmd, env, self._dir, log=log, prefix=self.namever()),
+                             'script_key': script_key, 'depinfo_script': depinfo})
+
+        if Crate.TIMINGS is not None:
+            Crate.TIMINGS.crate(self.namever(), self._builddeps)
+
+        # skip the crate if nothing that went into it has changed
+        inputs = fingerprint.digest({
+            'cmds': [c['cmd']._cmd for c in cmds],
+            'env': env,
+            'features': features,
+            'deps': deps,
+        })
+        record = fingerprint.load(out_dir, self.namever())
+        if os.path.isfile(output_name) and fingerprint.fresh(record, inputs):
+            print('Skipping %s, already built (needed by: %s)' % (self.namever(), str(by)))
+            self._env.update(record['env'])
+            self._fingerprint = record['fingerprint']
+            Crate.BUILT[self.namever()] = by
+            return ({'name': self.name, 'lib': output_name}, self._env, record['flags'])
+
+        if Crate.SCRIPT_CACHE is not None:
+            cmds = self.use_cached_scripts(cmds, env['OUT_DIR'])
 
         dbg(self._build)
         dbg('Building %s (needed by: %s)' % (self.namever(), str(by)))
+        open(log, 'w').close()
 
         bcmd = []
         benv = {}
@@ -594,22 +956,121 @@ class Crate(object):
 
             (c1, e1, e2) = runner(bcmd, benv)
 
+            if Crate.TIMINGS is not None and not isinstance(runner, CachedRunner):
+                kind = 'build-script' if isinstance(runner, BuildScriptRunner) else 'rustc'
+                Crate.TIMINGS.record(self.namever(), kind, runner)
+
             if runner.returncode != 0:
-                raise RuntimeError('build command failed: %s\nOutput: %s' % (runner.returncode, runner.stdout))
+                raise RuntimeError('build command for %s failed: %s\nOutput: %s\nFull log: %s' %
+                                   (self.namever(), runner.returncode, '\n'.join(runner.stderr or runner.stdout), log))
+
+            if Crate.SCRIPT_CACHE is not None and 'script_key' in c:
+                self.cache_script(c, (c1, e1, e2), env['OUT_DIR'])
 
             bcmd += c1
             benv = dict(benv, **e1)
 
             key = c['env_key']
-            for k, v in e2.iteritems():
+            for k, v in e2.items():
                 self._env['DEP_%s_%s' % (key.upper(), k.upper())] = v
 
+        sources = []
+        for c in cmds:
+            if 'depinfo' in c and os.path.isfile(c['depinfo']):
+                sources += fingerprint.parse_dep_info(c['depinfo'])
+        sources = fingerprint.hash_sources(sources)
+        self._fingerprint = fingerprint.combine(inputs, sources)
+        fingerprint.save(out_dir, self.namever(), {
+            'inputs': inputs,
+            'sources': sources,
+            'fingerprint': self._fingerprint,
+            'flags': bcmd,
+            'env': self._env,
+        })
+
         Crate.BUILT[self.namever()] = str(by)
         return ({'name': self.name, 'lib': output_name}, self._env, bcmd)
 
 
 
-def build(target_dir, crate_dir, target, blacklist, optionals):
+def lock_table(lock_data):
+    """
+    Index the lockfile packages by (name, version)
+    """
+    locks = {}
+    for lock in [lock_data['root']] + lock_data.get('package', []):
+        locks[(lock['name'], lock['version'])] = lock
+    return locks
+
+
+def resolve_all(target_dir):
+    while Crate.UNRESOLVED:
+        crate = Crate.UNRESOLVED.popleft()
+        crate.resolve(target_dir)
+
+
+def build_parallel(root, out_dir, jobs):
+    """
+    Build the resolved crate graph with up to jobs crates compiling
+    at once, each crate starting as soon as its dependencies are done
+    """
+    order = OrderedDict()
+    root.plan('cargo2rpm', [], order)
+
+    waiting = {}
+    dependents = dict((nv, []) for nv in order)
+    for nv in order:
+        deps = Crate.CRATES[nv]._builddeps
+        waiting[nv] = set(deps)
+        for dep in deps:
+            dependents[dep].append(nv)
+
+    results = {}
+    position = dict((nv, i) for i, nv in enumerate(order))
+
+    def dep_result(dep, crate):
+        # the first crate to need a dependency gets the flags from
+        # its own build, later ones its accumulated flags, as in build
+        dcrate = Crate.CRATES[dep]
+        if order[dep][0] == crate.namever():
+            return results[dep]
+        return (results[dep][0], dcrate._env, dcrate._extra_flags)
+
+    def submit(pool, running, nv):
+        crate = Crate.CRATES[nv]
+        by, features = order[nv]
+        externs = []
+        for dep in crate._builddeps:
+            extern, env, extra_flags = dep_result(dep, crate)
+            crate._dep_env[Crate.CRATES[dep].name] = env
+            crate._extra_flags += extra_flags
+            externs.append(extern)
+        running[pool.submit(crate.compile, by, out_dir, features, externs)] = nv
+
+    with futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        running = {}
+        for nv in order:
+            if not waiting[nv]:
+                submit(pool, running, nv)
+        while running:
+            done, _ = futures.wait(running, return_when=futures.FIRST_COMPLETED)
+            for f in sorted(done, key=lambda f: position[running[f]]):
+                nv = running.pop(f)
+                try:
+                    results[nv] = f.result()
+                except Exception as e:
+                    for other in running:
+                        other.cancel()
+                    raise RuntimeError('failed to build %s: %s' % (nv, e))
+                for dependent in dependents[nv]:
+                    waiting[dependent].discard(nv)
+                    if not waiting[dependent]:
+                        submit(pool, running, dependent)
+    return results[root.namever()]
+
+
+def build(target_dir, crate_dir, target, blacklist, optionals, store=None, jobs=1, manifest_cache=None,
+          script_cache=None, timings=False, lazy=False):
     print("target-dir:", target_dir)
     print("crate-dir:", crate_dir)
     print("target:", target)
@@ -617,6 +1078,7 @@ def build(target_dir, crate_dir, target, blacklist, optionals):
     target_dir = os.path.abspath(target_dir)
     crate_dir = os.path.abspath(crate_dir)
     rootdir = os.path.abspath('.')
+    set_manifest_cache(manifest_cache)
 
     crateinfo = crate_info_from_toml(target, rootdir)
     name = crateinfo.name
@@ -627,17 +1089,301 @@ def build(target_dir, crate_dir, target, blacklist, optionals):
     print("version:", ver)
 
     lock_data = lock_info(rootdir)
-    package_versions = lock_data['package']
     Crate.TARGET = target
     Crate.HOST = target
     Crate.CACHE = crate_dir
+    Crate.STORE = store
+    Crate.LAZY = lazy
+    Crate.SCRIPT_CACHE = script_cache
+    Crate.TIMINGS = Timings() if timings else None
+    Crate.LOCK = lock_data
     Crate.BLACKLIST = blacklist
     Crate.OPTIONALS = optionals
-    Crate.PACKAGES.append(lock_data['root'])
-    Crate.PACKAGES.extend(package_versions)
+    Crate.LOCKS = lock_table(lock_data)
     cargo_crate = Crate(name, ver, crateinfo, rootdir, build, deps)
-    Crate.UNRESOLVED.append(cargo_crate)
-    while len(Crate.UNRESOLVED) > 0:
-        crate = Crate.UNRESOLVED.pop(0)
-        crate.resolve(target_dir)
-    cargo_crate.build('cargo2rpm', target_dir)
+    Crate.queue(cargo_crate)
+    prefetch = start_prefetch(jobs) if jobs > 1 else None
+    try:
+        resolve_all(target_dir)
+    finally:
+        if prefetch is not None:
+            stop_prefetch(prefetch)
+    if manifest_cache is not None:
+        manifest_cache.close()
+    try:
+        if jobs > 1:
+            build_parallel(cargo_crate, target_dir, jobs)
+        else:
+            cargo_crate.build('cargo2rpm', target_dir)
+    finally:
+        if Crate.TIMINGS is not None:
+            print('Timings written to %s' % (Crate.TIMINGS.write(target_dir)))
+    if script_cache is not None:
+        script_cache.evict()
+
+
+def test_resolve_synthetic_lockfile():
+    """
+    Resolve a synthetic 5,000-package lockfile, with the crate
+    manifests handed in as already prefetched
+    """
+    n = 5000
+    source = 'registry+https://github.com/rust-lang/crates.io-index'
+    packages = []
+    for i in range(n):
+        deps = ['crate%d 1.%d.0 (%s)' % (j, j, source) for j in (i + 1, i + 2) if j < n]
+        packages.append({'name': 'crate%d' % i, 'version': '1.%d.0' % i, 'dependencies': deps})
+    root = {'name': 'root', 'version': '0.1.0', 'dependencies': ['crate0 1.0.0 (%s)' % source]}
+
+    def info(name, version, deps):
+        return {'name': name, 'version': version, 'deps': deps, 'build': [], 'features': []}
+
+    saved = Crate.LOCKS, Crate.UNRESOLVED, Crate.QUEUED, Crate.CRATES, Crate.PREFETCH
+    try:
+        Crate.LOCKS = lock_table({'root': root, 'package': packages})
+        Crate.UNRESOLVED = deque()
+        Crate.QUEUED = {}
+        Crate.CRATES = {}
+        Crate.PREFETCH = {}
+        for i, p in enumerate(packages):
+            # more requirements than locked dependencies, as with
+            # optional or target specific ones
+            dep_info = [{'name': 'crate%d' % j, 'req': '^1.%d' % j} for j in range(i + 1, i + 5)]
+            done = futures.Future()
+            done.set_result(('.', info(p['name'], p['version'], dep_info)))
+            Crate.PREFETCH['%s-%s' % (p['name'], p['version'])] = done
+        dep_info = [{'name': 'crate0', 'req': '^1.0'}]
+        top = Crate('root', '0.1.0', CrateInfo.from_dict(info('root', '0.1.0', dep_info)), '.', [], dep_info)
+        Crate.queue(top)
+        resolve_all('.')
+        crates = Crate.CRATES
+    finally:
+        Crate.LOCKS, Crate.UNRESOLVED, Crate.QUEUED, Crate.CRATES, Crate.PREFETCH = saved
+
+    assert len(crates) == n + 1
+    assert list(crates['root-0.1.0']._builddeps) == ['crate0-1.0.0']
+    assert sorted(crates['crate7-1.7.0']._builddeps) == ['crate8-1.8.0', 'crate9-1.9.0']
+    assert list(crates['crate%d-1.%d.0' % (n - 2, n - 2)]._builddeps) == ['crate%d-1.%d.0' % (n - 1, n - 1)]
+    assert sum(len(c._builddeps) for c in crates.values()) == 2 * n - 3 + 1
+
+
+_STUB_RUSTC = '''#!%s
+# stands in for rustc: writes the dep-info and an empty library,
+# or a build script printing a cargo: directive
+import os, sys
+args = sys.argv[1:]
+opt = lambda name: args[args.index(name) + 1]
+name, kind, out = opt('--crate-name'), opt('--crate-type'), opt('--out-dir')
+extra = [a for a in args if a.startswith('extra-filename=')][0].split('=', 1)[1]
+with open(os.path.join(out, 'rustc-calls'), 'a') as f:
+    f.write(name + '\\n')
+with open(os.path.join(out, name + extra + '.d'), 'w') as f:
+    f.write('%%s: %%s\\n' %% (name, args[0]))
+if kind == 'lib':
+    open(os.path.join(out, 'lib%%s%%s.rlib' %% (name, extra)), 'w').close()
+else:
+    exe = os.path.join(out, name + extra)
+    with open(exe, 'w') as f:
+        f.write('#!/bin/sh\\necho run >> "%%s/script-runs"\\n' %% (out))
+        f.write('echo cargo:rustc-cfg=stub_script\\necho cargo:rerun-if-changed=build.rs\\n')
+    os.chmod(exe, 0o755)
+'''
+
+
+class _StubToolchain(object):
+    """
+    A crate with a build script and a rustc stub on PATH that
+    only writes the files a real build would leave behind
+    """
+    def __init__(self, root):
+        self.root = root
+        self.bindir = os.path.join(root, 'bin')
+        self.cdir = os.path.join(root, 'foo-1.0.0')
+        self.out_dir = os.path.join(root, 'out')
+        for d in (self.bindir, os.path.join(self.cdir, 'src'), self.out_dir):
+            os.makedirs(d)
+        rustc = os.path.join(self.bindir, 'rustc')
+        with open(rustc, 'w') as f:
+            f.write(_STUB_RUSTC % (sys.executable))
+        os.chmod(rustc, 0o755)
+        for p in ('build.rs', 'src/lib.rs'):
+            self.write(p, 'fn main() {}\n')
+
+    def write(self, path, data):
+        with open(os.path.join(self.cdir, path), 'w') as f:
+            f.write(data)
+
+    def lines(self, name):
+        try:
+            with open(os.path.join(self.out_dir, name)) as f:
+                return f.read().split()
+        except IOError:
+            return []
+
+    def __enter__(self):
+        self.saved = (os.environ['PATH'], Crate.LOCKS, Crate.CRATES, Crate.BUILT,
+                      Crate.TARGET, Crate.HOST, Crate.SCRIPT_CACHE, Crate.TIMINGS)
+        os.environ['PATH'] = self.bindir + os.pathsep + os.environ['PATH']
+        Crate.LOCKS = {('foo', '1.0.0'): {'name': 'foo', 'version': '1.0.0'}}
+        Crate.CRATES = {}
+        Crate.BUILT = {}
+        Crate.TARGET = Crate.HOST = 'x86_64-unknown-linux-gnu'
+        Crate.SCRIPT_CACHE = Crate.TIMINGS = None
+        return self
+
+    def __exit__(self, *exc):
+        (os.environ['PATH'], Crate.LOCKS, Crate.CRATES, Crate.BUILT,
+         Crate.TARGET, Crate.HOST, Crate.SCRIPT_CACHE, Crate.TIMINGS) = self.saved
+
+    def compile(self):
+        # build paths as CrateInfo resolves them
+        build = [{'type': 'build_script', 'path': os.path.join(self.cdir, 'build.rs'), 'name': 'foo',
+                  'links': [], 'overrides': {}},
+                 {'type': 'lib', 'path': os.path.join(self.cdir, 'src', 'lib.rs'), 'name': 'foo', 'links': []}]
+        info = CrateInfo.from_dict({'name': 'foo', 'version': '1.0.0', 'deps': [], 'build': build, 'features': []})
+        crate = Crate('foo', '1.0.0', info, self.cdir, build, [])
+        return crate.compile('test', self.out_dir, ['std'], [])
+
+
+def test_compile():
+    """
+    Crate.compile end to end against a stub rustc
+    """
+    root = tempfile.mkdtemp()
+    try:
+        with _StubToolchain(root) as tc:
+            extern, env, flags = tc.compile()
+            assert extern == {'name': 'foo', 'lib': os.path.join(tc.out_dir, 'libfoo-1_0_0.rlib')}
+            assert flags == ['--cfg', 'stub_script']
+            assert tc.lines('rustc-calls') == ['build_script_foo', 'foo'] and tc.lines('script-runs') == ['run']
+
+            # unchanged, so nothing runs again
+            assert tc.compile()[2] == ['--cfg', 'stub_script']
+            assert len(tc.lines('rustc-calls')) == 2
+
+            tc.write('src/lib.rs', 'pub fn f() {}\n')
+            tc.compile()
+            assert len(tc.lines('rustc-calls')) == 4 and len(tc.lines('script-runs')) == 2
+    finally:
+        shutil.rmtree(root)
+
+
+def test_compile_script_cache():
+    """
+    A rebuild against a warm build script cache uses the cached
+    result instead of building and running the script again
+    """
+    from .buildcache import BuildScriptCache
+    root = tempfile.mkdtemp()
+    try:
+        with _StubToolchain(root) as tc:
+            Crate.SCRIPT_CACHE = BuildScriptCache(os.path.join(root, 'cache'))
+            assert tc.compile()[2] == ['--cfg', 'stub_script']
+            tc.write('src/lib.rs', 'pub fn f() {}\n')
+            assert tc.compile()[2] == ['--cfg', 'stub_script']
+            assert tc.lines('rustc-calls') == ['build_script_foo', 'foo', 'foo']
+            assert tc.lines('script-runs') == ['run']
+    finally:
+        shutil.rmtree(root)
+
+
+def test_build_parallel():
+    """
+    build_parallel on a stub crate graph whose compile step
+    only records what it was given
+    """
+    graph = {'app': ['a', 'f'], 'a': ['b', 'c'], 'b': ['d'], 'c': ['d', 'e'], 'd': [], 'e': [], 'f': []}
+    lock = threading.Lock()
+    active = [0, 0]
+    finished = []
+    # d and e can only get past this together, i.e. with two jobs
+    together = threading.Barrier(2, timeout=5)
+
+    class StubCrate(object):
+        plan = Crate.plan
+
+        def __init__(self, name, fail):
+            self.name = name
+            self.fail = fail
+            self._builddeps = OrderedDict(('%s-1.0.0' % d, {}) for d in graph[name])
+            self._dep_env = {}
+            self._extra_flags = []
+            self._env = {}
+
+        def namever(self):
+            return '%s-1.0.0' % (self.name)
+
+        def compile(self, by, out_dir, features, externs):
+            with lock:
+                active[0] += 1
+                active[1] = max(active[1], active[0])
+                assert all(dep in finished for dep in self._builddeps)
+            try:
+                if self.name in ('d', 'e'):
+                    together.wait()
+                if self.name == self.fail:
+                    raise ValueError('compile error')
+                return ('--extern %s' % (self.name), {}, [])
+            finally:
+                with lock:
+                    active[0] -= 1
+                    finished.append(self.namever())
+
+    saved = Crate.CRATES
+    try:
+        Crate.CRATES = dict(('%s-1.0.0' % n, StubCrate(n, None)) for n in graph)
+        assert build_parallel(Crate.CRATES['app-1.0.0'], 'out', 2) == ('--extern app', {}, [])
+        assert len(finished) == len(graph) and finished[-1] == 'app-1.0.0'
+        assert active[1] == 2
+
+        # a failure stops the crates depending on it
+        del finished[:]
+        together.reset()
+        Crate.CRATES = dict(('%s-1.0.0' % n, StubCrate(n, 'b')) for n in graph)
+        try:
+            build_parallel(Crate.CRATES['app-1.0.0'], 'out', 2)
+            assert False
+        except RuntimeError as e:
+            assert 'b-1.0.0' in str(e)
+        assert 'a-1.0.0' not in finished and 'app-1.0.0' not in finished
+
+        active[1] = 0
+        del finished[:]
+        Crate.CRATES = dict(('%s-1.0.0' % n, StubCrate(n, None)) for n in graph)
+        together = threading.Barrier(1)
+        build_parallel(Crate.CRATES['app-1.0.0'], 'out', 1)
+        assert active[1] == 1 and len(finished) == len(graph)
+    finally:
+        Crate.CRATES = saved
+
+
+def test_extract_crate():
+    import io
+    root = tempfile.mkdtemp()
+
+    def mkcrate(namever, members):
+        cfp = os.path.join(root, '%s.crate' % (namever))
+        with tarfile.open(cfp, 'w:gz') as tf:
+            for name, data in members:
+                ti = tarfile.TarInfo(name)
+                ti.size = len(data)
+                tf.addfile(ti, io.BytesIO(data))
+        return cfp
+
+    try:
+        cfp = mkcrate('foo-1.0.0', [('foo-1.0.0/Cargo.toml', b'[package]\n'), ('foo-1.0.0/src/lib.rs', b'')])
+        assert extract_crate(cfp, root, 'foo-1.0.0') == os.path.join(root, 'foo-1.0.0')
+        assert os.path.isfile(os.path.join(root, 'foo-1.0.0', 'src', 'lib.rs'))
+        manifest, files = read_crate_manifest(cfp, 'foo-1.0.0')
+        assert manifest == '[package]\n'
+        assert files == set(['foo-1.0.0/Cargo.toml', 'foo-1.0.0/src/lib.rs'])
+
+        cfp = mkcrate('bad-1.0.0', [('bad-1.0.0/../../evil', b'x')])
+        try:
+            extract_crate(cfp, root, 'bad-1.0.0')
+            assert False, 'path traversal not detected'
+        except Exception as e:
+            assert 'Path Traversal' in str(e)
+        assert sorted(os.listdir(root)) == ['bad-1.0.0.crate', 'foo-1.0.0', 'foo-1.0.0.crate']
+    finally:
+        shutil.rmtree(root)
@@ -0,0 +1,153 @@
+# cargoapi.buildcache
+# cache of build script results across bootstrap runs
+#
+# Entries are keyed by a digest of the build script's rustc
+# command line, environment, features and dependencies. Each
+# holds the parsed cargo: directives and a copy of the script's
+# OUT_DIR, and stays valid while the script's sources (and any
+# rerun-if-changed files or rerun-if-env-changed variables) are
+# unchanged.
+
+import os
+import json
+import errno
+import shutil
+import tempfile
+from . import fingerprint
+from . import cache_root, evict_lru
+
+_DEFAULT_MAX_ENTRIES = 2000
+
+
+def default_root():
+    return cache_root('CARGO2RPM_BUILD_CACHE', 'build-scripts')
+
+
+class BuildScriptCache(object):
+    def __init__(self, root=None, max_entries=_DEFAULT_MAX_ENTRIES):
+        self.root = os.path.abspath(root or default_root())
+        self.max_entries = max_entries
+        if not os.path.isdir(self.root):
+            try:
+                os.makedirs(self.root)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def _dir(self, key):
+        return os.path.join(self.root, key[0:2], key)
+
+    def lookup(self, key):
+        """
+        Return the cached (cmd, env, denv) for key, or None
+        if there is no entry or its inputs have changed
+        """
+        try:
+            with open(os.path.join(self._dir(key), 'record.json'), 'r') as f:
+                record = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        for var, value in record.get('envs', {}).items():
+            if os.environ.get(var) != value:
+                return None
+        if not fingerprint.fresh(record, key):
+            return None
+        os.utime(self._dir(key), None)
+        return record['result']
+
+    def restore(self, key, out_dir):
+        """
+        Replace out_dir with the cached OUT_DIR products for key
+        """
+        src = os.path.join(self._dir(key), 'out')
+        if not os.path.isdir(src):
+            return False
+        if os.path.isdir(out_dir):
+            shutil.rmtree(out_dir)
+        shutil.copytree(src, out_dir, symlinks=True)
+        return True
+
+    def store(self, key, result, sources, envs, out_dir):
+        """
+        Cache the result of running a build script
+        sources: files whose contents the result depends on
+        envs: environment variables the result depends on
+        """
+        d = self._dir(key)
+        parent = os.path.dirname(d)
+        if not os.path.isdir(parent):
+            try:
+                os.makedirs(parent)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        tmp = tempfile.mkdtemp(dir=parent)
+        try:
+            if os.path.isdir(out_dir):
+                shutil.copytree(out_dir, os.path.join(tmp, 'out'), symlinks=True)
+            else:
+                os.makedirs(os.path.join(tmp, 'out'))
+            with open(os.path.join(tmp, 'record.json'), 'w') as f:
+                json.dump({
+                    'inputs': key,
+                    'sources': fingerprint.hash_sources(sources),
+                    'envs': dict((var, os.environ.get(var)) for var in envs),
+                    'result': result,
+                }, f, sort_keys=True)
+            if os.path.isdir(d):
+                shutil.rmtree(d)
+            os.rename(tmp, d)
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+
+    def evict(self, max_entries=None):
+        """
+        Remove the least recently used entries beyond max_entries
+        Returns the number of entries removed
+        """
+        if max_entries is None:
+            max_entries = self.max_entries
+        removed, total = evict_lru(self.entries(), max_entries=max_entries,
+                                   remove=lambda p: shutil.rmtree(p, ignore_errors=True))
+        return removed
+
+    def entries(self):
+        for d in os.listdir(self.root):
+            dp = os.path.join(self.root, d)
+            if not os.path.isdir(dp):
+                continue
+            for k in os.listdir(dp):
+                # skip entries still being written by store()
+                if not k.startswith('tmp'):
+                    yield os.path.join(dp, k)
+
+
+def test_buildcache():
+    root = tempfile.mkdtemp()
+    try:
+        cache = BuildScriptCache(os.path.join(root, 'cache'))
+        src = os.path.join(root, 'build.rs')
+        with open(src, 'w') as f:
+            f.write('fn main() {}\n')
+        out = os.path.join(root, 'out')
+        os.makedirs(out)
+        with open(os.path.join(out, 'gen.rs'), 'w') as f:
+            f.write('// generated\n')
+
+        key = fingerprint.digest(['rustc', src])
+        assert cache.lookup(key) is None
+        result = [['-l', 'z'], {}, {'root': out}]
+        cache.store(key, result, [src], ['CARGO2RPM_TEST_UNSET'], out)
+        assert cache.lookup(key) == result
+
+        shutil.rmtree(out)
+        assert cache.restore(key, out)
+        assert os.path.isfile(os.path.join(out, 'gen.rs'))
+
+        with open(src, 'w') as f:
+            f.write('fn main() { }\n')
+        assert cache.lookup(key) is None
+        assert cache.evict(0) == 1
+    finally:
+        shutil.rmtree(root)
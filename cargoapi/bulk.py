@@ -0,0 +1,109 @@
+# cargoapi.bulk
+# concurrent metadata queries for many crates
+#
+# The blocking fetch functions run on a thread pool (each worker
+# thread keeps its own pooled session) behind an asyncio semaphore
+# that bounds how many requests are in flight. Results are yielded
+# as they complete rather than in request order, so callers can
+# stream them out.
+
+import asyncio
+import threading
+from concurrent import futures
+from . import fetch_crate_metadata
+
+_DEFAULT_LIMIT = 16
+
+
+async def bulk(names, fetch, limit=_DEFAULT_LIMIT):
+    """
+    Call fetch(name) for every name with at most limit calls in
+    flight. Yields (name, result, exception) as each completes;
+    exactly one of result and exception is None
+    """
+    loop = asyncio.get_running_loop()
+    sem = asyncio.Semaphore(limit)
+    with futures.ThreadPoolExecutor(max_workers=limit) as pool:
+        async def one(name):
+            async with sem:
+                try:
+                    return name, await loop.run_in_executor(pool, fetch, name), None
+                except Exception as e:
+                    return name, None, e
+
+        tasks = [asyncio.ensure_future(one(name)) for name in names]
+        try:
+            for task in asyncio.as_completed(tasks):
+                yield await task
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+def crate_versions(name):
+    """
+    The version numbers crates.io lists for a crate
+    """
+    return [v['num'] for v in fetch_crate_metadata(name)['versions']]
+
+
+async def metadata(names, limit=_DEFAULT_LIMIT):
+    async for item in bulk(names, fetch_crate_metadata, limit):
+        yield item
+
+
+async def versions(names, limit=_DEFAULT_LIMIT):
+    async for item in bulk(names, crate_versions, limit):
+        yield item
+
+
+def iterate(agen):
+    """
+    Drive an async generator from synchronous code, yielding
+    its items as they are produced
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(agen.__anext__())
+            except StopAsyncIteration:
+                break
+    finally:
+        loop.run_until_complete(agen.aclose())
+        loop.close()
+
+
+def test_bulk():
+    active = [0, 0]
+    lock = threading.Lock()
+    done = dict((name, threading.Event()) for name in ['a', 'b', 'c', 'bad'])
+
+    def fetch(name):
+        with lock:
+            active[0] += 1
+            active[1] = max(active[1], active[0])
+        try:
+            assert done[name].wait(5)
+            if name == 'bad':
+                raise ValueError(name)
+            return name.upper()
+        finally:
+            with lock:
+                active[0] -= 1
+
+    # let the calls finish one at a time, so only one can be the
+    # next result; 'bad' only starts once 'b' frees a slot
+    gen = iterate(bulk(['a', 'b', 'c', 'bad'], fetch, limit=3))
+    results = []
+    for name in ['b', 'bad', 'c', 'a']:
+        done[name].set()
+        results.append(next(gen))
+    assert list(gen) == []
+    assert [r[0] for r in results] == ['b', 'bad', 'c', 'a']
+    assert results[0] == ('b', 'B', None) and isinstance(results[1][2], ValueError)
+    assert active[1] == 3
+
+    active[1] = 0
+    list(iterate(bulk(['a', 'b', 'c'], fetch, limit=1)))
+    assert active[1] == 1
@@ -0,0 +1,259 @@
+# cargoapi.download
+# resumable downloads with retries and per-host limits
+#
+# Downloads go to a partial file that is kept when a transfer
+# fails, and the next attempt (in this run or a later one) asks
+# for the rest with an HTTP Range request. Dropped connections,
+# timeouts and 408/429/5xx responses are retried with jittered
+# exponential backoff. A semaphore per host bounds the number of
+# concurrent requests to it.
+
+import os
+import time
+import random
+import shutil
+import tempfile
+import threading
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+import requests
+from . import session
+
+_CHUNK_SIZE = 64 * 1024
+_RETRY_STATUS = (408, 429, 500, 502, 503, 504)
+_RETRY_ERRORS = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)
+_TIMEOUT = (15, 60)
+_STATS = ('downloads', 'resumed', 'retries', 'failures', 'bytes')
+
+retries = 5
+backoff_base = 0.5
+backoff_cap = 30.0
+host_limit = 4
+
+_lock = threading.Lock()
+_counters = dict((k, 0) for k in _STATS)
+_host_slots = {}
+
+
+def configure(max_retries=None, per_host=None):
+    """
+    Set the number of retries and the concurrent requests per host
+    """
+    global retries, host_limit
+    with _lock:
+        if max_retries is not None:
+            retries = max_retries
+        if per_host is not None and per_host != host_limit:
+            host_limit = per_host
+            _host_slots.clear()
+
+
+def _count(key, n=1):
+    with _lock:
+        _counters[key] += n
+
+
+def stats():
+    """
+    Return the download counters of this process: completed
+    downloads, resumed transfers, retries, failures and bytes
+    """
+    with _lock:
+        return dict(_counters)
+
+
+def reset_stats():
+    with _lock:
+        for k in _STATS:
+            _counters[k] = 0
+
+
+def host_slot(url):
+    """
+    The semaphore bounding concurrent requests to url's host
+    """
+    host = urlparse(url).netloc
+    with _lock:
+        slot = _host_slots.get(host)
+        if slot is None:
+            slot = _host_slots[host] = threading.BoundedSemaphore(host_limit)
+        return slot
+
+
+def backoff(attempt):
+    """
+    Seconds to wait before retry number attempt (from 0),
+    exponential with full jitter
+    """
+    return random.uniform(0, min(backoff_cap, backoff_base * (2 ** attempt)))
+
+
+class _RetryStatus(Exception):
+    def __init__(self, response):
+        Exception.__init__(self, "HTTP %d" % (response.status_code))
+        self.response = response
+
+
+def with_retries(fn, sleep=time.sleep):
+    """
+    Call fn until it succeeds, backing off between attempts
+    that fail with a transient error
+    """
+    attempt = 0
+    while True:
+        try:
+            return fn()
+        except _RETRY_ERRORS + (_RetryStatus,) as e:
+            if attempt >= retries:
+                _count('failures')
+                if isinstance(e, _RetryStatus):
+                    e.response.raise_for_status()
+                raise
+            _count('retries')
+            sleep(backoff(attempt))
+            attempt += 1
+
+
+def _check(r):
+    if r.status_code in _RETRY_STATUS:
+        r.close()
+        raise _RetryStatus(r)
+    r.raise_for_status()
+
+
+def get(url, sleep=time.sleep):
+    """
+    GET url into memory, retrying transient failures
+    Returns the response
+    """
+    def attempt():
+        with host_slot(url):
+            r = session().get(url, timeout=_TIMEOUT)
+        _check(r)
+        return r
+    r = with_retries(attempt, sleep)
+    _count('downloads')
+    _count('bytes', len(r.content))
+    return r
+
+
+def _range_start(r):
+    # "bytes 100-199/200" -> 100
+    try:
+        return int(r.headers.get('Content-Range', '').split()[1].split('-')[0])
+    except (IndexError, ValueError):
+        return None
+
+
+def fetch_to(url, part, sleep=time.sleep):
+    """
+    Download url into the file part, continuing from whatever
+    part already holds. part is left in place if this fails
+    Returns the final url
+    """
+    def attempt():
+        offset = os.path.getsize(part) if os.path.isfile(part) else 0
+        headers = {'Range': 'bytes=%d-' % (offset)} if offset else {}
+        with host_slot(url):
+            r = session().get(url, headers=headers, stream=True, timeout=_TIMEOUT)
+            try:
+                if r.status_code == 416 and offset:
+                    # nothing left to fetch
+                    return r.url
+                _check(r)
+                if offset and r.status_code == 206 and _range_start(r) == offset:
+                    _count('resumed')
+                    mode = 'ab'
+                else:
+                    mode = 'wb'
+                with open(part, mode) as f:
+                    for chunk in r.iter_content(_CHUNK_SIZE):
+                        f.write(chunk)
+                        _count('bytes', len(chunk))
+                return r.url
+            finally:
+                r.close()
+    url = with_retries(attempt, sleep)
+    _count('downloads')
+    return url
+
+
+class _Server(object):
+    """
+    HTTP stand-in serving one file with Range support, failing
+    the first few requests as told
+    """
+    def __init__(self, data, fail):
+        from http.server import HTTPServer, BaseHTTPRequestHandler
+        server = self
+        self.data = data
+        self.fail = list(fail)
+        self.ranges = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                rng = self.headers.get('Range')
+                server.ranges.append(rng)
+                start = int(rng.split('=')[1].rstrip('-')) if rng else 0
+                how = server.fail.pop(0) if server.fail else None
+                if how == 503:
+                    self.send_error(503)
+                    return
+                body = server.data[start:]
+                self.send_response(206 if rng else 200)
+                if rng:
+                    self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, len(server.data) - 1,
+                                                                         len(server.data)))
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                if how == 'drop':
+                    self.wfile.write(body[:len(body) // 2])
+                    self.wfile.flush()
+                    self.close_connection = True
+                    return
+                self.wfile.write(body)
+
+        self.httpd = HTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d/crate' % (self.httpd.server_address[1])
+        t = threading.Thread(target=self.httpd.serve_forever)
+        t.daemon = True
+        t.start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def test_resumable_download():
+    root = tempfile.mkdtemp()
+    data = os.urandom(256 * 1024)
+    server = _Server(data, ['drop', 503, 'drop'])
+    waits = []
+    try:
+        reset_stats()
+        part = os.path.join(root, 'crate.part')
+        assert fetch_to(server.url, part, sleep=waits.append) == server.url
+        with open(part, 'rb') as f:
+            assert f.read() == data
+        assert server.ranges[0] is None and server.ranges[-1] == 'bytes=%d-' % (len(data) * 3 // 4)
+        s = stats()
+        assert (s['downloads'], s['retries'], s['resumed'], s['failures']) == (1, 3, 2, 0)
+        assert len(waits) == 3 and all(0 <= w <= backoff_base * 4 for w in waits)
+
+        server.fail = [503] * (retries + 1)
+        try:
+            get(server.url, sleep=waits.append)
+            assert False
+        except requests.HTTPError as e:
+            assert e.response.status_code == 503
+        assert stats()['failures'] == 1
+        assert host_slot(server.url) is host_slot(server.url + '?x')
+    finally:
+        server.close()
+        reset_stats()
+        shutil.rmtree(root)
@@ -0,0 +1,141 @@
+# cargoapi.fingerprint
+# cargo-style fingerprints for incremental bootstrap builds
+#
+# A crate's fingerprint covers its rustc command lines, build
+# environment, enabled features, the fingerprints of its
+# dependencies and the contents of every source file rustc
+# listed in its dep-info output. A crate is only rebuilt when
+# its fingerprint changes.
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+from . import atomic_file
+
+_DIR = '.fingerprint'
+
+
+def digest(value):
+    """
+    Stable sha256 of a JSON-serialisable value
+    """
+    data = json.dumps(value, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def hash_file(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def parse_dep_info(path):
+    """
+    Return the source files listed in a rustc dep-info (.d) file
+    """
+    sources = []
+    seen = set()
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if not line or line.startswith('#') or ':' not in line:
+                continue
+            _, deps = line.split(': ', 1) if ': ' in line else (line, '')
+            # paths with spaces are escaped as '\ '
+            for dep in deps.replace('\\ ', '\0').split():
+                dep = dep.replace('\0', ' ')
+                if dep not in seen:
+                    seen.add(dep)
+                    sources.append(dep)
+    return sources
+
+
+def hash_sources(sources):
+    """
+    Map each source file to the sha256 of its content,
+    missing files map to None
+    """
+    hashes = {}
+    for src in sources:
+        try:
+            hashes[src] = hash_file(src)
+        except (IOError, OSError):
+            hashes[src] = None
+    return hashes
+
+
+def _path(out_dir, namever):
+    return os.path.join(out_dir, _DIR, '%s.json' % (namever))
+
+
+def load(out_dir, namever):
+    try:
+        with open(_path(out_dir, namever), 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def save(out_dir, namever, record):
+    p = _path(out_dir, namever)
+    d = os.path.dirname(p)
+    if not os.path.isdir(d):
+        os.makedirs(d)
+    with atomic_file(p, 'w') as f:
+        json.dump(record, f, sort_keys=True)
+
+
+def fresh(record, inputs):
+    """
+    True if record was built from the same inputs and none of
+    its recorded source files have changed since
+    """
+    if record is None or record.get('inputs') != inputs:
+        return False
+    sources = record.get('sources', {})
+    return hash_sources(list(sources)) == sources
+
+
+def combine(inputs, sources):
+    """
+    The fingerprint dependents see: inputs plus source contents
+    """
+    return digest([inputs, sorted(sources.items())])
+
+
+def test_fingerprint():
+    root = tempfile.mkdtemp()
+    try:
+        src = os.path.join(root, 'my src.rs')
+        with open(src, 'w') as f:
+            f.write('fn main() {}\n')
+        dinfo = os.path.join(root, 'foo.d')
+        with open(dinfo, 'w') as f:
+            esc = src.replace(' ', '\\ ')
+            f.write('%s/libfoo.rlib: %s\n\n%s:\n' % (root, esc, esc))
+        assert parse_dep_info(dinfo) == [src]
+
+        inputs = digest({'cmd': ['rustc', src], 'features': ['default']})
+        record = {'inputs': inputs, 'sources': hash_sources([src])}
+        save(root, 'foo-1.0.0', record)
+        assert fresh(load(root, 'foo-1.0.0'), inputs)
+        assert not fresh(load(root, 'foo-1.0.0'), digest({'cmd': []}))
+        assert load(root, 'bar-1.0.0') is None
+        with open(src, 'w') as f:
+            f.write('fn main() { }\n')
+        assert not fresh(load(root, 'foo-1.0.0'), inputs)
+
+        # a failed save keeps the old record and leaves no temp file
+        try:
+            save(root, 'foo-1.0.0', {'inputs': object()})
+            assert False
+        except TypeError:
+            pass
+        assert load(root, 'foo-1.0.0') == record
+        assert os.listdir(os.path.dirname(_path(root, 'foo-1.0.0'))) == ['foo-1.0.0.json']
+    finally:
+        shutil.rmtree(root)
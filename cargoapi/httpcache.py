@@ -0,0 +1,293 @@
+# cargoapi.httpcache
+# persistent cache for index and API responses
+#
+# Bodies are stored along with their ETag / Last-Modified
+# validators. Entries younger than the TTL are served without
+# touching the network, older entries are revalidated with a
+# conditional request.
+
+import os
+import json
+import time
+import errno
+import fcntl
+import shutil
+import hashlib
+import tempfile
+import threading
+import requests
+from . import cache_root, atomic_file, evict_lru
+
+_DEFAULT_TTL = 300
+_DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+# eviction makes this much room, so that the next misses don't
+# each have to scan the cache again
+_LOW_WATER = 0.9
+_STATS = ('hits', 'revalidated', 'misses', 'stale', 'evicted')
+
+
+def default_root():
+    return cache_root('CARGO2RPM_HTTP_CACHE', 'http')
+
+
+def _write_atomic(path, data):
+    with atomic_file(path) as f:
+        f.write(data)
+
+
+def _remove_entry(body_path):
+    for path in (body_path[:-len('.body')] + '.json', body_path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+class HTTPCache(object):
+    """
+    ttl: seconds an entry is used without revalidation,
+         None to never revalidate (fully offline)
+    max_size: bytes of bodies to keep before evicting the
+              least recently used entries
+    """
+    def __init__(self, root=None, ttl=_DEFAULT_TTL, max_size=_DEFAULT_MAX_SIZE):
+        self.root = os.path.abspath(root or default_root())
+        self.ttl = ttl
+        self.max_size = max_size
+        self.counters = dict((k, 0) for k in _STATS)
+        self._lock = threading.Lock()
+        # bytes of bodies, counted by the last scan plus what this
+        # process added since; None until the first scan
+        self._size = None
+        if not os.path.isdir(self.root):
+            try:
+                os.makedirs(self.root)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def _paths(self, url):
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        base = os.path.join(self.root, key)
+        return base + '.json', base + '.body'
+
+    def _count(self, key):
+        with self._lock:
+            self.counters[key] += 1
+
+    def _load(self, url):
+        meta_path, body_path = self._paths(url)
+        try:
+            with open(meta_path, 'rb') as f:
+                meta = json.loads(f.read().decode('utf-8'))
+            with open(body_path, 'rb') as f:
+                body = f.read()
+        except (IOError, OSError, ValueError):
+            return None, None
+        if meta.get('url') != url:
+            return None, None
+        return meta, body
+
+    def _save(self, url, meta, body):
+        meta_path, body_path = self._paths(url)
+        meta['url'] = url
+        if body is not None:
+            _write_atomic(body_path, body)
+        else:
+            os.utime(body_path, None)
+        _write_atomic(meta_path, json.dumps(meta).encode('utf-8'))
+
+    def _fresh(self, meta, ttl):
+        if ttl is None:
+            return True
+        return time.time() - meta.get('fetched', 0) < ttl
+
+    def get(self, session, url, ttl=-1):
+        """
+        Return (body, final_url) for url, from the cache if possible
+        ttl overrides the cache-wide TTL for this request
+        """
+        if ttl == -1:
+            ttl = self.ttl
+        meta, body = self._load(url)
+        if meta is not None and self._fresh(meta, ttl):
+            self._count('hits')
+            os.utime(self._paths(url)[1], None)
+            return body, meta.get('final_url', url)
+
+        headers = {}
+        if meta is not None:
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+        try:
+            r = session.get(url, headers=headers)
+        except requests.RequestException:
+            if meta is None:
+                raise
+            self._count('stale')
+            return body, meta.get('final_url', url)
+
+        if r.status_code == 304 and meta is not None:
+            self._count('revalidated')
+            meta['fetched'] = time.time()
+            self._save(url, meta, None)
+            return body, meta.get('final_url', url)
+
+        r.raise_for_status()
+        self._count('misses')
+        self._save(url, {
+            'etag': r.headers.get('ETag'),
+            'last_modified': r.headers.get('Last-Modified'),
+            'final_url': r.url,
+            'fetched': time.time(),
+        }, r.content)
+        self._added(len(r.content))
+        return r.content, r.url
+
+    def resolve(self, session, url):
+        """
+        Return the url that url redirects to
+        Redirect targets of immutable resources are cached forever
+        """
+        meta, _ = self._load(url)
+        if meta is not None:
+            self._count('hits')
+            return meta['final_url']
+        r = session.head(url, allow_redirects=True)
+        r.raise_for_status()
+        self._count('misses')
+        self._save(url, {'final_url': r.url, 'fetched': time.time()}, b'')
+        return r.url
+
+    def entries(self):
+        for f in os.listdir(self.root):
+            if f.endswith('.body'):
+                yield os.path.join(self.root, f)
+
+    def _added(self, nbytes):
+        # only scan the cache when it may have outgrown max_size
+        if self.max_size is None:
+            return
+        with self._lock:
+            if self._size is not None:
+                self._size += nbytes
+            over = self._size is None or self._size > self.max_size
+        if over:
+            self.evict(int(self.max_size * _LOW_WATER))
+
+    def evict(self, max_size=None):
+        """
+        Drop least recently used entries until the cached
+        bodies take up no more than max_size bytes
+        """
+        if max_size is None:
+            max_size = self.max_size
+        if max_size is None:
+            return 0
+        removed, total = evict_lru(self.entries(), max_size=max_size, remove=_remove_entry)
+        with self._lock:
+            self.counters['evicted'] += removed
+            self._size = total
+        return removed
+
+    def stats(self):
+        """
+        Return the cumulative counters, including this process
+        """
+        stats = self._load_stats()
+        with self._lock:
+            for k, v in self.counters.items():
+                stats[k] = stats.get(k, 0) + v
+        return stats
+
+    def _load_stats(self):
+        try:
+            with open(os.path.join(self.root, 'stats'), 'rb') as f:
+                return json.loads(f.read().decode('utf-8'))
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def flush_stats(self):
+        """
+        Add the counters of this process to the persistent totals
+        The totals are locked while they are updated, so that
+        processes sharing the cache don't lose each other's counts
+        """
+        with self._lock:
+            counters = self.counters
+            self.counters = dict((k, 0) for k in _STATS)
+        fd = os.open(os.path.join(self.root, 'stats.lock'), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            stats = self._load_stats()
+            for k, v in counters.items():
+                stats[k] = stats.get(k, 0) + v
+            _write_atomic(os.path.join(self.root, 'stats'), json.dumps(stats).encode('utf-8'))
+        finally:
+            os.close(fd)
+        return stats
+
+    def clear(self):
+        shutil.rmtree(self.root)
+        os.makedirs(self.root)
+
+
+class _FakeResponse(object):
+    def __init__(self, status_code, content=b'', headers=None, url=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+        self.url = url
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(self.status_code)
+
+
+class _FakeSession(object):
+    def __init__(self):
+        self.requests = []
+
+    def get(self, url, headers=None):
+        self.requests.append(headers)
+        if headers and headers.get('If-None-Match') == '"v1"':
+            return _FakeResponse(304, url=url)
+        return _FakeResponse(200, b'body', {'ETag': '"v1"'}, url)
+
+
+def test_httpcache():
+    root = tempfile.mkdtemp()
+    try:
+        s = _FakeSession()
+        cache = HTTPCache(root, ttl=60)
+        assert cache.get(s, 'http://x/a') == (b'body', 'http://x/a')
+        assert cache.get(s, 'http://x/a') == (b'body', 'http://x/a')
+        assert len(s.requests) == 1
+        assert cache.get(s, 'http://x/a', ttl=0) == (b'body', 'http://x/a')
+        assert s.requests[-1] == {'If-None-Match': '"v1"'}
+        assert cache.counters['misses'] == 1
+        assert cache.counters['hits'] == 1
+        assert cache.counters['revalidated'] == 1
+        cache.flush_stats()
+        assert cache.stats()['hits'] == 1
+        other = HTTPCache(root, ttl=60)
+        other.get(s, 'http://x/a')
+        assert other.flush_stats()['hits'] == 2 and cache.flush_stats()['hits'] == 2
+        cache.get(s, 'http://x/b')
+        assert cache.evict(4) == 1
+
+        # misses only scan the cache once it may be over its size
+        small = HTTPCache(os.path.join(root, 'small'), ttl=60, max_size=20)
+        scans = []
+        entries = small.entries
+        small.entries = lambda: scans.append(1) or entries()
+        for i in range(5):
+            small.get(s, 'http://x/%d' % (i))
+        assert len(scans) == 1
+        small.get(s, 'http://x/5')
+        assert len(scans) == 2 and small.counters['evicted'] == 2
+        assert len(list(entries())) == 4
+    finally:
+        shutil.rmtree(root)
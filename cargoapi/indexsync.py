@@ -0,0 +1,193 @@
+# cargoapi.indexsync
+# incremental sync of the crates.io index into local stores
+#
+# A bare mirror of the index repository is kept up to date with
+# dulwich. Each store synced from it (a snapshot file or a registry
+# database) remembers the commit it was last synced to in a
+# "<store>.commit" file next to it, so a sync only fetches the new
+# objects and applies the crate files changed between that commit
+# and the new head. A store without a recorded commit is built
+# from the whole tree.
+
+import os
+import shutil
+import tempfile
+from dulwich.repo import Repo
+from dulwich.client import get_transport_and_path
+from dulwich.diff_tree import tree_changes
+from . import index_for_crate, cache_root, atomic_file
+
+INDEX_GIT_URL = 'https://github.com/rust-lang/crates.io-index'
+
+
+def default_mirror():
+    return cache_root(None, 'crates.io-index.git')
+
+
+def open_mirror(path):
+    if os.path.isdir(path):
+        return Repo(path)
+    os.makedirs(path)
+    return Repo.init_bare(path)
+
+
+def fetch(repo, url=INDEX_GIT_URL, branch=b'master'):
+    """
+    Fetch new objects from url into the mirror
+    Returns the commit id of the remote branch
+    """
+    client, path = get_transport_and_path(url)
+    result = client.fetch(path, repo)
+    refs = getattr(result, 'refs', result)
+    head = refs.get(b'refs/heads/' + branch) or refs.get(b'HEAD')
+    if head is None:
+        raise ValueError("%s has no branch %s" % (url, branch.decode('utf-8')))
+    repo.refs[b'refs/remotes/origin/' + branch] = head
+    return head
+
+
+def _is_crate_path(path):
+    name = os.path.basename(path)
+    return not name.startswith('.') and name != 'config.json' and \
+        index_for_crate('', name).lstrip('/') == path
+
+
+def changed_crates(repo, old, new):
+    """
+    Return {name: contents or None if removed} for every crate
+    file that differs between commits old and new. If old is None
+    every crate in new is returned
+    """
+    store = repo.object_store
+    old_tree = store[old].tree if old is not None else None
+    new_tree = store[new].tree
+    changes = {}
+    for change in tree_changes(store, old_tree, new_tree):
+        for entry, removed in ((change.old, True), (change.new, False)):
+            if entry is None or entry.path is None:
+                continue
+            path = entry.path.decode('utf-8')
+            if not _is_crate_path(path):
+                continue
+            name = os.path.basename(path)
+            if removed:
+                changes.setdefault(name, None)
+            else:
+                changes[name] = store[entry.sha].data
+    return changes
+
+
+def _state_path(target):
+    return target + '.commit'
+
+
+def synced_commit(target):
+    """
+    The commit target was last synced to, or None
+    """
+    if not os.path.exists(target):
+        return None
+    try:
+        with open(_state_path(target), 'r') as f:
+            return f.read().strip().encode('ascii') or None
+    except (IOError, OSError):
+        return None
+
+
+def _mark_synced(target, commit):
+    p = _state_path(target)
+    with atomic_file(os.path.abspath(p), 'w', prefix='.commit.') as f:
+        f.write(commit.decode('ascii') + '\n')
+
+
+def apply_to_snapshot(path, changes, full=False):
+    """
+    Write a new snapshot at path with changes applied. Blocks
+    of unchanged crates are copied without recompressing them
+    """
+    from .snapshot import Snapshot, SnapshotWriter
+    with SnapshotWriter(path) as w:
+        if not full and os.path.isfile(path):
+            with Snapshot(path) as old:
+                for name in old.names():
+                    if name not in changes:
+                        w.add_compressed(name, old.block(name))
+        for name, data in sorted(changes.items()):
+            if data is not None:
+                w.add(name, data)
+
+
+def apply_to_db(path, changes, full=False):
+    from .registrydb import RegistryDB
+    with RegistryDB(path) as db:
+        db.apply(changes, full)
+
+
+def sync(repo, head, snapshot=None, db=None):
+    """
+    Bring the snapshot and/or registry database at the given paths
+    up to date with commit head
+    Returns {path: number of crates changed}
+    """
+    result = {}
+    for path, apply in ((snapshot, apply_to_snapshot), (db, apply_to_db)):
+        if path is None:
+            continue
+        old = synced_commit(path)
+        if old == head:
+            result[path] = 0
+            continue
+        if old is not None and old not in repo.object_store:
+            old = None
+        changes = changed_crates(repo, old, head)
+        apply(path, changes, full=old is None)
+        _mark_synced(path, head)
+        result[path] = len(changes)
+    return result
+
+
+def test_indexsync():
+    import json
+    from dulwich import porcelain
+    from .snapshot import Snapshot
+    from .registrydb import RegistryDB
+    from . import write_index
+    root = tempfile.mkdtemp()
+    try:
+        upstream = os.path.join(root, 'upstream')
+        porcelain.init(upstream)
+
+        def publish(crates, removed=()):
+            paths = []
+            for name, versions in crates.items():
+                p = index_for_crate(upstream, name)
+                write_index(p, [json.dumps({'name': name, 'vers': v, 'deps': [], 'features': {}}) + '\n'
+                                for v in versions])
+                paths.append(p)
+            for name in removed:
+                porcelain.rm(upstream, [index_for_crate(upstream, name)])
+            if paths:
+                porcelain.add(upstream, paths)
+            return porcelain.commit(upstream, message=b'update', author=b'a <a@b>', committer=b'a <a@b>')
+
+        publish({'libc': ['0.2.0'], 'serde': ['1.0.0'], 'rand': ['0.3.0']})
+        mirror = open_mirror(os.path.join(root, 'mirror.git'))
+        snap = os.path.join(root, 'index.snapshot')
+        db = os.path.join(root, 'registry.sqlite')
+        head = fetch(mirror, upstream)
+        assert sync(mirror, head, snap, db) == {snap: 3, db: 3}
+        assert sync(mirror, head, snap, db) == {snap: 0, db: 0}
+
+        publish({'serde': ['1.0.0', '1.0.1']}, removed=['rand'])
+        head = fetch(mirror, upstream)
+        assert changed_crates(mirror, synced_commit(snap), head) == {
+            'serde': b'{"name": "serde", "vers": "1.0.0", "deps": [], "features": {}}\n'
+                     b'{"name": "serde", "vers": "1.0.1", "deps": [], "features": {}}\n',
+            'rand': None}
+        assert sync(mirror, head, snap, db) == {snap: 2, db: 2}
+        with Snapshot(snap) as s:
+            assert s.names() == ['libc', 'serde'] and b'1.0.1' in s.get('serde')
+        with RegistryDB(db) as r:
+            assert r.crates() == ['libc', 'serde'] and r.versions('serde') == ['1.0.0', '1.0.1']
+    finally:
+        shutil.rmtree(root)
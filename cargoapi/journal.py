@@ -0,0 +1,180 @@
+# cargoapi.journal
+# batched updates of the local registry index
+#
+# RPM scriptlets append install/remove intents to a journal in
+# the index root, which is cheap. A single flush (from %posttrans)
+# then rewrites each affected index file once and makes one commit
+# for the whole transaction.
+
+import os
+import json
+import shutil
+import tempfile
+from collections import OrderedDict
+from . import index_for_crate, index_lock, replace_crate, commit
+
+_JOURNAL = '.cargo2rpm-journal'
+
+
+class Journal(object):
+    def __init__(self, root):
+        self.root = root
+        self.path = os.path.join(root, _JOURNAL)
+        self._lock = None
+
+    def __enter__(self):
+        self._lock = index_lock(self.root)
+        self._lock.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        self._lock.__exit__(*exc)
+        self._lock = None
+
+    def _write(self, record):
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record, sort_keys=True) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _append(self, record):
+        with self:
+            self._write(record)
+
+    def install(self, name, version, entry):
+        """
+        Record that name-version was installed with index entry
+        """
+        self._append({'op': 'install', 'name': name, 'vers': version, 'entry': entry.strip()})
+
+    def remove(self, name, version):
+        """
+        Record that name-version was removed
+        """
+        self._append({'op': 'remove', 'name': name, 'vers': version})
+
+    def pending(self):
+        if not os.path.isfile(self.path):
+            return []
+        with open(self.path, 'r') as f:
+            return [json.loads(l) for l in f if l.strip()]
+
+    def flush(self, do_commit=True, message=None):
+        """
+        Apply all journaled intents: one rewrite per affected
+        index file, then one commit for all of them
+        Returns the list of rewritten index files
+        """
+        with self:
+            records = self.pending()
+            if not records:
+                return []
+
+            byfile = OrderedDict()
+            intents = []
+            rewritten = []
+            for rec in records:
+                if rec['op'] == 'rewritten':
+                    # left by a flush whose commit failed
+                    rewritten.extend(rec['files'])
+                    continue
+                intents.append(rec)
+                indexfile = index_for_crate(self.root, rec['name'])
+                byfile.setdefault(indexfile, []).append(rec)
+
+            updates = []
+            for indexfile, recs in byfile.items():
+                entries = OrderedDict()
+                if os.path.isfile(indexfile):
+                    with open(indexfile, 'r') as f:
+                        for line in f:
+                            if line.strip():
+                                entries[json.loads(line)['vers']] = line
+                before = list(entries.values())
+                for rec in recs:
+                    if rec['op'] == 'install':
+                        entries[rec['vers']] = '%s\n' % (rec['entry'])
+                    else:
+                        entries.pop(rec['vers'], None)
+                after = list(entries.values())
+                if after != before:
+                    updates.append((indexfile, recs[0]['name'], after))
+
+            changed = [indexfile for indexfile, name, after in updates]
+            if do_commit:
+                changed = list(OrderedDict.fromkeys(rewritten + changed))
+                if changed != rewritten:
+                    # noted before touching anything, so that a replay
+                    # after a crash or failed commit still commits them
+                    self._write({'op': 'rewritten', 'files': changed})
+            for indexfile, name, after in updates:
+                replace_crate(indexfile, name, after)
+            if do_commit and changed:
+                if message is None:
+                    message = 'update %d crates' % (len(intents))
+                commit(self.root, changed, message)
+
+            # replaying is idempotent, so only drop the journal
+            # once everything has been applied and committed
+            os.unlink(self.path)
+            return changed
+
+
+def test_journal():
+    root = tempfile.mkdtemp()
+    try:
+        j = Journal(root)
+        j.install('serde', '1.0.0', '{"name":"serde","vers":"1.0.0"}')
+        j.install('serde', '1.0.1', '{"name":"serde","vers":"1.0.1"}\n')
+        j.install('libc', '0.2.0', '{"name":"libc","vers":"0.2.0"}')
+        j.remove('serde', '1.0.0')
+        assert len(j.pending()) == 4
+        changed = j.flush(do_commit=False)
+        assert sorted(changed) == [index_for_crate(root, 'libc'), index_for_crate(root, 'serde')]
+        with open(index_for_crate(root, 'serde')) as f:
+            assert f.read() == '{"name":"serde","vers":"1.0.1"}\n'
+        assert j.pending() == []
+        assert j.flush(do_commit=False) == []
+
+        # removing from a crate with no index file writes nothing
+        j.remove('rand', '0.1.0')
+        assert j.flush(do_commit=False) == []
+        assert not os.path.exists(index_for_crate(root, 'rand'))
+
+        # a commit that fails keeps the journal, and the replay
+        # commits the files rewritten by the failed flush
+        import cargoapi.journal as journal
+        committed = []
+
+        def failing(root, files, message):
+            raise IOError('commit failed')
+
+        journal.commit = failing
+        try:
+            j.install('libc', '0.2.1', '{"name":"libc","vers":"0.2.1"}')
+            try:
+                j.flush()
+                assert False
+            except IOError:
+                pass
+            assert os.path.isfile(j.path)
+            journal.commit = lambda root, files, message: committed.append(files)
+            assert j.flush() == [index_for_crate(root, 'libc')]
+            assert committed == [[index_for_crate(root, 'libc')]]
+            assert j.pending() == []
+        finally:
+            journal.commit = commit
+
+        # flushindex --sidecar keeps the sidecars current
+        from . import set_sidecars
+        from .versionindex import VersionIndex
+        set_sidecars(True)
+        try:
+            j.install('serde', '1.0.2', '{"name":"serde","vers":"1.0.2"}')
+            j.flush(do_commit=False)
+            with VersionIndex(index_for_crate(root, 'serde')) as vi:
+                assert not vi.rebuilt and vi.line('1.0.2') == '{"name":"serde","vers":"1.0.2"}\n'
+        finally:
+            set_sidecars(False)
+    finally:
+        shutil.rmtree(root)
@@ -0,0 +1,137 @@
+# cargoapi.manifestcache
+# persistent cache of parsed Cargo.toml manifests
+#
+# Entries are keyed by the target, the crate directory and the
+# manifest's size and mtime, so an edited manifest is parsed
+# again while unpacked crates are only ever parsed once.
+
+import os
+import json
+import errno
+import shutil
+import hashlib
+import tempfile
+from . import cache_root, atomic_file, evict_lru
+
+_DEFAULT_MAX_ENTRIES = 20000
+
+
+def default_root():
+    return cache_root('CARGO2RPM_MANIFEST_CACHE', 'manifests')
+
+
+def manifest_key(target, cdir, path=None):
+    """
+    Return the cache key for the manifest in cdir, or None if there
+    is no manifest to key on. path is the file the manifest is read
+    from, if not cdir/Cargo.toml (such as the packed .crate)
+    """
+    cdir = os.path.abspath(cdir)
+    if path is None:
+        path = os.path.join(cdir, 'Cargo.toml')
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    ident = '%s\0%s\0%s\0%d\0%d' % (target, cdir, os.path.abspath(path), st.st_size, int(st.st_mtime * 1000000))
+    return hashlib.sha256(ident.encode('utf-8')).hexdigest()
+
+
+class ManifestCache(object):
+    def __init__(self, root=None, max_entries=_DEFAULT_MAX_ENTRIES):
+        self.root = os.path.abspath(root or default_root())
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._memo = {}
+        self._added = 0
+        if not os.path.isdir(self.root):
+            try:
+                os.makedirs(self.root)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def _path(self, key):
+        return os.path.join(self.root, key[0:2], key[2:] + '.json')
+
+    def get(self, key):
+        if key in self._memo:
+            self.hits += 1
+            return self._memo[key]
+        p = self._path(key)
+        try:
+            with open(p, 'rb') as f:
+                value = json.loads(f.read().decode('utf-8'))
+            os.utime(p, None)
+        except (IOError, OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._memo[key] = value
+        return value
+
+    def put(self, key, value):
+        self._memo[key] = value
+        p = self._path(key)
+        d = os.path.dirname(p)
+        if not os.path.isdir(d):
+            try:
+                os.makedirs(d)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        with atomic_file(p) as f:
+            f.write(json.dumps(value).encode('utf-8'))
+        self._added += 1
+
+    def evict(self, max_entries=None):
+        """
+        Remove the least recently used entries beyond max_entries
+        Returns the number of entries removed
+        """
+        if max_entries is None:
+            max_entries = self.max_entries
+        removed, total = evict_lru(self.entries(), max_entries=max_entries)
+        return removed
+
+    def entries(self):
+        for d in os.listdir(self.root):
+            dp = os.path.join(self.root, d)
+            if not os.path.isdir(dp):
+                continue
+            for f in os.listdir(dp):
+                if f.endswith('.json'):
+                    yield os.path.join(dp, f)
+
+    def close(self):
+        """
+        Evict old entries if anything was added
+        """
+        if self._added:
+            self.evict()
+            self._added = 0
+
+
+def test_manifestcache():
+    root = tempfile.mkdtemp()
+    try:
+        cdir = os.path.join(root, 'foo-1.0.0')
+        os.makedirs(cdir)
+        with open(os.path.join(cdir, 'Cargo.toml'), 'w') as f:
+            f.write('[package]\n')
+        key = manifest_key('x86_64', cdir)
+        assert key == manifest_key('x86_64', cdir)
+        assert key != manifest_key('i686', cdir)
+        assert manifest_key('x86_64', root) is None
+
+        cache = ManifestCache(os.path.join(root, 'cache'), max_entries=1)
+        assert cache.get(key) is None
+        cache.put(key, {'name': 'foo'})
+        assert ManifestCache(cache.root).get(key) == {'name': 'foo'}
+        cache.put('ab' * 32, {'name': 'bar'})
+        os.utime(cache._path(key), (0, 0))
+        assert cache.evict() == 1
+        assert ManifestCache(cache.root).get(key) is None
+    finally:
+        shutil.rmtree(root)
@@ -0,0 +1,187 @@
+# cargoapi.mirror
+# offline registry covering a set of Cargo.lock files
+#
+# The mirror uses the same layout as an installed system:
+#   <root>/index                              registry index (git)
+#   <root>/crates/<name>/<version>/download   the crate
+#   <root>/crates/<name>/<version>/registry.json
+# registry.json is only written once the crate next to it has been
+# downloaded and verified, so a crate with one is complete and an
+# interrupted mirror run resumes where it stopped.
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+from collections import OrderedDict
+from concurrent import futures
+from dulwich import porcelain
+from . import index_for_crate, index_entry, update_crate, commit, write_index, index_lock
+from . import lock_checksum, fetch_index_entry, fetch_crates, index_source
+from .fingerprint import hash_file
+
+
+def lock_packages(locks):
+    """
+    The union of the registry packages in parsed Cargo.lock files
+    Returns an OrderedDict of (name, version) -> checksum or None
+    """
+    packages = OrderedDict()
+    for lock in locks:
+        for pkg in lock.get('package', []):
+            if not pkg.get('source', '').startswith('registry+'):
+                continue
+            key = (pkg['name'], pkg['version'])
+            cksum = lock_checksum(lock, pkg)
+            if packages.get(key) is None:
+                packages[key] = cksum
+    return packages
+
+
+class Mirror(object):
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self.index = os.path.join(self.root, 'index')
+        self.crates = os.path.join(self.root, 'crates')
+
+    def crate_dir(self, name, version):
+        return os.path.join(self.crates, name, version)
+
+    def download_path(self, name, version):
+        return os.path.join(self.crate_dir(name, version), 'download')
+
+    def _entry_path(self, name, version):
+        return os.path.join(self.crate_dir(name, version), 'registry.json')
+
+    def entry(self, name, version):
+        """
+        The recorded index entry of a complete crate, or None
+        """
+        try:
+            with open(self._entry_path(name, version), 'r') as f:
+                return f.read().strip()
+        except (IOError, OSError):
+            return None
+
+    def init(self):
+        """
+        Create the index repository and its config.json
+        """
+        if not os.path.isdir(os.path.join(self.index, '.git')):
+            if not os.path.isdir(self.index):
+                os.makedirs(self.index)
+            porcelain.init(self.index)
+        config = os.path.join(self.index, 'config.json')
+        if not os.path.isfile(config):
+            write_index(config, [json.dumps({'dl': 'file://%s/{crate}/{version}/download' % (self.crates)}) + '\n'])
+            commit(self.index, config, 'add config.json')
+
+    def _index_entries(self, packages, jobs):
+        # the index line of every package, fetching each crate's
+        # index file once
+        wanted = OrderedDict()
+        for name, version in packages:
+            wanted.setdefault(name, []).append(version)
+        names = list(wanted)
+        source = index_source()
+        if source is not None and hasattr(source, 'fetch_many'):
+            files = source.fetch_many(names)
+        elif jobs > 1 and len(names) > 1:
+            with futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+                files = dict(zip(names, pool.map(fetch_index_entry, names, [wanted[n] for n in names])))
+        else:
+            files = dict((n, fetch_index_entry(n, wanted[n])) for n in names)
+        entries = {}
+        for name, data in files.items():
+            for line in (data or b'').decode('utf-8').splitlines():
+                if line.strip():
+                    e = json.loads(line)
+                    entries[(name, e['vers'])] = line.strip()
+        result = OrderedDict()
+        for key in packages:
+            if key not in entries:
+                raise ValueError("%s %s not found in index" % key)
+            result[key] = entries[key]
+        return result
+
+    def sync(self, packages, jobs=8, store=None):
+        """
+        Make the mirror cover packages, a mapping of (name, version)
+        to checksum (or None to use the index checksum)
+        Returns (downloaded, reused, index files changed)
+        """
+        self.init()
+        todo = [key for key in packages if self.entry(*key) is None]
+        entries = self._index_entries(todo, jobs) if todo else {}
+
+        downloads = []
+        reused = 0
+        for key in todo:
+            cksum = packages[key] or json.loads(entries[key])['cksum']
+            path = self.download_path(*key)
+            if os.path.isfile(path) and hash_file(path) == cksum:
+                # downloaded by a run that stopped before recording it
+                reused += 1
+                continue
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            downloads.append((key[0], key[1], path, cksum))
+        fetch_crates(downloads, jobs=jobs, store=store)
+        for key in todo:
+            write_index(self._entry_path(*key), [entries[key] + '\n'])
+
+        changed = []
+        with index_lock(self.index):
+            for (name, version) in packages:
+                entry = self.entry(name, version)
+                indexfile = index_for_crate(self.index, name)
+                line = index_entry(indexfile, version)
+                if line is None or line.strip() != entry:
+                    update_crate(indexfile, name, version, entry)
+                    if indexfile not in changed:
+                        changed.append(indexfile)
+            if changed:
+                commit(self.index, changed, 'mirror %d crates' % (len(packages)))
+        return len(downloads), reused, len(changed)
+
+
+def test_mirror():
+    import cargoapi
+    from .sparse import SparseIndex, _serve
+    root = tempfile.mkdtemp()
+    server = None
+    try:
+        upstream = os.path.join(root, 'upstream')
+        crates = {}
+        for name, version in [('libc', '0.2.0'), ('rand', '0.3.0')]:
+            data = ('%s-%s' % (name, version)).encode('utf-8')
+            crates[(name, version)] = data
+            write_index(index_for_crate(upstream, name), [json.dumps(
+                {'name': name, 'vers': version, 'cksum': hashlib.sha256(data).hexdigest(), 'deps': []}) + '\n'])
+        server, url = _serve(upstream)
+        cargoapi.set_index_source(SparseIndex(url))
+
+        reg = 'registry+https://github.com/rust-lang/crates.io-index'
+        locks = [{'package': [{'name': 'app', 'version': '0.1.0'},
+                              {'name': 'libc', 'version': '0.2.0', 'source': reg}]},
+                 {'package': [{'name': 'libc', 'version': '0.2.0', 'source': reg},
+                              {'name': 'rand', 'version': '0.3.0', 'source': reg}]}]
+        packages = lock_packages(locks)
+        assert list(packages) == [('libc', '0.2.0'), ('rand', '0.3.0')]
+
+        # as left behind by an interrupted run
+        m = Mirror(os.path.join(root, 'mirror'))
+        for key, data in crates.items():
+            os.makedirs(m.crate_dir(*key))
+            with open(m.download_path(*key), 'wb') as f:
+                f.write(data)
+        assert m.sync(packages) == (0, 2, 2)
+        assert json.loads(index_entry(index_for_crate(m.index, 'rand'), '0.3.0'))['name'] == 'rand'
+        assert m.sync(packages) == (0, 0, 0)
+    finally:
+        cargoapi.set_index_source(None)
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+        shutil.rmtree(root)
@@ -0,0 +1,287 @@
+# cargoapi.registrydb
+# SQLite mirror of the local registry index
+#
+# The flat index files stay the source cargo reads. This database
+# holds the same entries split into crates, versions, deps and
+# features tables so that queries like "all versions of X" or
+# "who depends on Y" are an indexed lookup instead of a walk over
+# the index directory parsing every line.
+#
+# Crate names are case-insensitive: index files are named after the
+# lowercased name while entries keep the published case, so rows are
+# looked up, replaced and removed by name with COLLATE NOCASE.
+
+import os
+import json
+import shutil
+import sqlite3
+import tempfile
+from . import index_for_crate, index_files
+from . import semver
+
+_DB = '.cargo2rpm-registry.sqlite'
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS crates (
+    name TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS versions (
+    id INTEGER PRIMARY KEY,
+    crate TEXT NOT NULL REFERENCES crates(name),
+    vers TEXT NOT NULL,
+    cksum TEXT,
+    yanked INTEGER NOT NULL DEFAULT 0,
+    links TEXT,
+    entry TEXT NOT NULL,
+    UNIQUE (crate, vers)
+);
+CREATE TABLE IF NOT EXISTS deps (
+    version_id INTEGER NOT NULL REFERENCES versions(id) ON DELETE CASCADE,
+    crate TEXT NOT NULL,
+    name TEXT NOT NULL,
+    req TEXT NOT NULL,
+    kind TEXT,
+    optional INTEGER NOT NULL DEFAULT 0,
+    default_features INTEGER NOT NULL DEFAULT 1,
+    target TEXT
+);
+CREATE TABLE IF NOT EXISTS features (
+    version_id INTEGER NOT NULL REFERENCES versions(id) ON DELETE CASCADE,
+    feature TEXT NOT NULL,
+    enables TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE INDEX IF NOT EXISTS versions_crate ON versions(crate);
+CREATE INDEX IF NOT EXISTS versions_crate_nocase ON versions(crate COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS crates_nocase ON crates(name COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS deps_crate_nocase ON deps(crate COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS deps_crate ON deps(crate);
+CREATE INDEX IF NOT EXISTS deps_version ON deps(version_id);
+CREATE INDEX IF NOT EXISTS features_version ON features(version_id);
+'''
+
+
+def default_path(root):
+    return os.path.join(root, _DB)
+
+
+class RegistryDB(object):
+    def __init__(self, path):
+        self.path = path
+        self._db = sqlite3.connect(path)
+        self._db.execute('PRAGMA foreign_keys = ON')
+        self._db.execute('PRAGMA journal_mode = WAL')
+        self._db.executescript(_SCHEMA)
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _insert(self, entry):
+        e = json.loads(entry)
+        name = e['name']
+        self._db.execute('INSERT OR IGNORE INTO crates (name) VALUES (?)', (name,))
+        self._db.execute('DELETE FROM versions WHERE crate = ? COLLATE NOCASE AND vers = ?', (name, e['vers']))
+        cur = self._db.execute(
+            'INSERT INTO versions (crate, vers, cksum, yanked, links, entry) VALUES (?, ?, ?, ?, ?, ?)',
+            (name, e['vers'], e.get('cksum'), int(bool(e.get('yanked'))), e.get('links'), entry.strip()))
+        vid = cur.lastrowid
+        self._db.executemany(
+            'INSERT INTO deps (version_id, crate, name, req, kind, optional, default_features, target) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            [(vid, d.get('package') or d['name'], d['name'], d['req'], d.get('kind'),
+              int(bool(d.get('optional'))), int(d.get('default_features', True)), d.get('target'))
+             for d in e.get('deps', [])])
+        self._db.executemany(
+            'INSERT INTO features (version_id, feature, enables) VALUES (?, ?, ?)',
+            [(vid, f, json.dumps(enables)) for f, enables in sorted(e.get('features', {}).items())])
+
+    def _mark_complete(self):
+        self._db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('complete', '1')")
+
+    def complete(self):
+        """
+        True once the database has been loaded from a whole index,
+        rather than only holding the versions written since it
+        was created
+        """
+        return self._db.execute("SELECT 1 FROM meta WHERE key = 'complete'").fetchone() is not None
+
+    def _drop_empty(self, name):
+        self._db.execute('DELETE FROM crates WHERE name = ? COLLATE NOCASE AND NOT EXISTS '
+                         '(SELECT 1 FROM versions WHERE crate = crates.name)', (name,))
+
+    def update(self, name, version, entry):
+        """
+        Add or replace one version, as update_crate does
+        """
+        with self._db:
+            self._insert(entry)
+
+    def remove(self, name, version):
+        """
+        Remove one version, as remove_crate does
+        """
+        with self._db:
+            self._db.execute('DELETE FROM versions WHERE crate = ? COLLATE NOCASE AND vers = ?', (name, version))
+            self._drop_empty(name)
+
+    def replace(self, name, lines):
+        """
+        Replace every version of name with the entries in lines
+        """
+        with self._db:
+            self._db.execute('DELETE FROM versions WHERE crate = ? COLLATE NOCASE', (name,))
+            for line in lines:
+                if line.strip():
+                    self._insert(line)
+            self._drop_empty(name)
+
+    def apply(self, changes, full=False):
+        """
+        Apply {name: index file contents, or None if removed} in
+        one transaction. With full, crates not in changes are
+        dropped as well
+        """
+        with self._db:
+            if full:
+                self._db.execute('DELETE FROM versions')
+                self._db.execute('DELETE FROM crates')
+                self._mark_complete()
+            for name, data in changes.items():
+                self._db.execute('DELETE FROM versions WHERE crate = ? COLLATE NOCASE', (name,))
+                if data is not None:
+                    for line in data.decode('utf-8').splitlines():
+                        if line.strip():
+                            self._insert(line)
+                self._drop_empty(name)
+
+    def rebuild(self, root):
+        """
+        Reload the whole database from the index files under root
+        Returns the number of versions loaded
+        """
+        with self._db:
+            self._db.execute('DELETE FROM versions')
+            self._db.execute('DELETE FROM crates')
+            for name, p in index_files(root):
+                with open(p, 'r') as f:
+                    for line in f:
+                        if line.strip():
+                            self._insert(line)
+            self._mark_complete()
+        return self._db.execute('SELECT COUNT(*) FROM versions').fetchone()[0]
+
+    def crates(self):
+        return [r[0] for r in self._db.execute('SELECT name FROM crates ORDER BY name')]
+
+    def versions(self, name, yanked=True):
+        """
+        All versions of name, in ascending semver order
+        """
+        q = 'SELECT vers FROM versions WHERE crate = ? COLLATE NOCASE'
+        if not yanked:
+            q += ' AND yanked = 0'
+        return sorted((r[0] for r in self._db.execute(q, (name,))),
+                      key=lambda v: semver.Semver(v).sort_key)
+
+    def entry(self, name, version):
+        """
+        The index entry of one version as a dict, or None
+        """
+        r = self._db.execute('SELECT entry FROM versions WHERE crate = ? COLLATE NOCASE AND vers = ?',
+                             (name, version)).fetchone()
+        return json.loads(r[0]) if r else None
+
+    def features(self, name, version):
+        return dict((f, json.loads(enables)) for f, enables in self._db.execute(
+            'SELECT feature, enables FROM features JOIN versions ON versions.id = version_id '
+            'WHERE crate = ? COLLATE NOCASE AND vers = ? ORDER BY feature', (name, version)))
+
+    def dependencies(self, name, version):
+        return [dict(zip(('crate', 'name', 'req', 'kind', 'optional', 'target'), r)) for r in self._db.execute(
+            'SELECT deps.crate, deps.name, req, kind, optional, target FROM deps '
+            'JOIN versions ON versions.id = version_id WHERE versions.crate = ? COLLATE NOCASE AND vers = ?',
+            (name, version))]
+
+    def dependents(self, name):
+        """
+        Return (crate, version, req, kind) for every version
+        depending on the crate name
+        """
+        return [tuple(r) for r in self._db.execute(
+            'SELECT versions.crate, vers, req, kind FROM deps JOIN versions ON versions.id = version_id '
+            'WHERE deps.crate = ? COLLATE NOCASE ORDER BY versions.crate, vers', (name,))]
+
+    def latest(self, name, req=None):
+        """
+        The highest non-yanked version of name, optionally
+        matching the requirement req, or None
+        """
+        versions = self.versions(name, yanked=False)
+        if req is None:
+            return versions[-1] if versions else None
+        v = semver.semver_range(req).max_satisfying(versions)
+        return str(v) if v is not None else None
+
+
+def test_registrydb():
+    from . import update_crate, remove_crate, set_registry_db
+    root = tempfile.mkdtemp()
+    try:
+        db = RegistryDB(default_path(root))
+        set_registry_db(db)
+        entries = [
+            {'name': 'libc', 'vers': '0.2.9', 'deps': [], 'features': {}, 'cksum': 'a', 'yanked': False},
+            {'name': 'libc', 'vers': '0.2.10', 'deps': [], 'features': {'std': []}, 'cksum': 'b', 'yanked': False},
+            {'name': 'libc', 'vers': '0.2.11', 'deps': [], 'features': {}, 'cksum': 'c', 'yanked': True},
+            {'name': 'rand', 'vers': '0.3.0', 'features': {'default': ['std']}, 'cksum': 'd', 'yanked': False,
+             'deps': [{'name': 'c', 'package': 'libc', 'req': '^0.2', 'kind': 'normal', 'optional': False,
+                       'default_features': True, 'target': None, 'features': []}]},
+        ]
+        for e in entries:
+            update_crate(index_for_crate(root, e['name']), e['name'], e['vers'], json.dumps(e))
+        assert db.versions('libc') == ['0.2.9', '0.2.10', '0.2.11']
+        assert db.latest('libc') == '0.2.10'
+        assert db.latest('libc', '<0.2.10') == '0.2.9'
+        assert db.dependents('libc') == [('rand', '0.3.0', '^0.2', 'normal')]
+        assert db.dependencies('rand', '0.3.0')[0]['name'] == 'c'
+        assert db.features('rand', '0.3.0') == {'default': ['std']}
+        assert db.entry('libc', '0.2.9')['cksum'] == 'a'
+
+        remove_crate(index_for_crate(root, 'rand'), 'rand', '0.3.0')
+        assert db.dependents('libc') == [] and db.crates() == ['libc']
+
+        # index files are named after the lowercased crate name
+        mixed = {'name': 'Inflector', 'vers': '0.11.4', 'deps': [], 'features': {}}
+        db.update('Inflector', '0.11.4', json.dumps(mixed))
+        db.apply({'inflector': None})
+        assert db.crates() == ['libc']
+        db.update('Inflector', '0.11.4', json.dumps(mixed))
+        db.replace('inflector', [json.dumps(dict(mixed, vers='0.11.5'))])
+        assert db.versions('Inflector') == ['0.11.5'] and db.crates() == ['Inflector', 'libc']
+        assert db.versions('inflector') == ['0.11.5'] and db.latest('inflector') == '0.11.5'
+        assert db.entry('inflector', '0.11.5')['name'] == 'Inflector'
+        assert db.features('INFLECTOR', '0.11.5') == {} and db.dependencies('inflector', '0.11.5') == []
+        assert db.dependents('LIBC') == db.dependents('libc')
+        db.remove('inflector', '0.11.5')
+        assert db.crates() == ['libc']
+
+        set_registry_db(None)
+        other = RegistryDB(os.path.join(root, 'other.sqlite'))
+        assert not db.complete() and not other.complete()
+        assert other.rebuild(root) == 3 and other.complete()
+        assert other.versions('libc', yanked=False) == ['0.2.9', '0.2.10']
+        other.close()
+        db.close()
+    finally:
+        set_registry_db(None)
+        shutil.rmtree(root)
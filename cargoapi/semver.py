@@ -25,6 +25,10 @@
 #
 
 import re
+import time
+import bisect
+import random
+from array import array
 
 
 SV_RANGE = re.compile(r'^(?P<op>(?:\<=|\>=|=|\<|\>|\^|\~))?\s*'
@@ -40,18 +44,37 @@ SEMVER = re.compile(r'^\s*(?P<major>(?:0|[1-9][0-9]*))'
                     r'(\+(?P<build>[0-9A-Za-z-]+(\.[0-9A-Za-z-]+)*))?$')
 
 
+_INTERN_LIMIT = 100000
+
+
+def _identifier_key(part):
+    # numeric identifiers sort before alphanumeric ones
+    if part.isdigit():
+        return (0, int(part), '')
+    return (1, 0, part)
+
+
 class PreRelease(object):
+    """
+    Pre-release part of a version, ordered as follows:
+    an empty pre-release is highest, longer pre-releases are
+    higher than shorter ones, and same-length ones compare
+    piece by piece (numeric < non-numeric, numbers by value,
+    others in ASCII order)
+    """
+    __slots__ = ('_container', '_key')
 
     def __init__(self, pr):
         self._container = []
         if pr is not None:
             self._container += str(pr).split('.')
+        self._key = (len(self._container), tuple(_identifier_key(p) for p in self._container))
 
     def __str__(self):
         return '.'.join(self._container)
 
     def __repr__(self):
-        return self._container
+        return repr(self._container)
 
     def __getitem__(self, key):
         return self._container[key]
@@ -59,6 +82,9 @@ class PreRelease(object):
     def __len__(self):
         return len(self._container)
 
+    def key(self):
+        return self._key
+
     def __gt__(self, rhs):
         return not ((self < rhs) or (self == rhs))
 
@@ -74,136 +100,111 @@ class PreRelease(object):
     def __ne__(self, rhs):
         return not (self == rhs)
 
+    def __hash__(self):
+        return hash(str(self))
+
     def __lt__(self, rhs):
         if self == rhs:
             return False
-
         # not having a pre-release is higher precedence
         if len(self) == 0:
-            if len(rhs) == 0:
-                return False
-            else:
-                # 1.0.0 > 1.0.0-alpha
-                return False
-        else:
-            if len(rhs) is None:
-                # 1.0.0-alpha < 1.0.0
-                return True
-
-        # if both have one, then longer pre-releases are higher precedence
-        if len(self) > len(rhs):
-            # 1.0.0-alpha.1 > 1.0.0-alpha
             return False
-        elif len(self) < len(rhs):
-            # 1.0.0-alpha < 1.0.0-alpha.1
-            return True
-
-        # if both have the same length pre-release, must check each piece
-        # numeric sub-parts have lower precedence than non-numeric sub-parts
-        # non-numeric sub-parts are compared lexically in ASCII sort order
-        for l, r in zip(self, rhs):
-            if l.isdigit():
-                if r.isdigit():
-                    if int(l) < int(r):
-                        # 2 > 1
-                        return True
-                    elif int(l) > int(r):
-                        # 1 < 2
-                        return False
-                    else:
-                        # 1 == 1
-                        continue
-                else:
-                    # 1 < 'foo'
-                    return True
-            else:
-                if r.isdigit():
-                    # 'foo' > 1
-                    return False
+        return self._key < rhs._key
+
+
+_interned = {}
 
-            # both are non-numeric
-            if l < r:
-                return True
-            elif l > r:
-                return False
 
-        raise RuntimeError('PreRelease __lt__ failed')
+class Semver(object):
+    """
+    Immutable parsed version
+    Parsed strings are interned, so Semver('1.2.3') twice
+    returns the same object. sort_key is a precomputed tuple
+    giving the same order as the comparison operators.
+    """
+    __slots__ = ('_input', '_raw', 'prerelease', 'sort_key', '_eq_key', '_str')
 
+    _FIELDS = ('major', 'minor', 'patch', 'prerelease', 'build')
 
-class Semver(dict):
+    def __new__(cls, sv):
+        if isinstance(sv, Semver):
+            return sv
+        cached = _interned.get(sv)
+        if cached is not None:
+            return cached
 
-    def __init__(self, sv):
         match = SEMVER.match(str(sv))
         if match is None:
             raise ValueError('%s is not a valid semver string' % sv)
 
-        self._input = sv
-        self.update(match.groupdict())
-        self.prerelease = PreRelease(self['prerelease'])
-
-    def __str__(self):
-        major, minor, patch, prerelease, build = self.parts_raw()
-        s = ''
-        if major is None:
-            s += '0'
-        else:
-            s += major
-        s += '.'
-        if minor is None:
-            s += '0'
-        else:
-            s += minor
-        s += '.'
-        if patch is None:
-            s += '0'
-        else:
-            s += patch
-        if len(self.prerelease):
-            s += '-' + str(self.prerelease)
+        self = object.__new__(cls)
+        d = match.groupdict()
+        raw = tuple(d[f] for f in Semver._FIELDS)
+        major, minor, patch, prerelease, build = raw
+        pre = PreRelease(prerelease)
+        nums = (int(major or 0), int(minor or 0), int(patch or 0))
+        s = '%d.%d.%d' % nums
+        if len(pre):
+            s += '-' + str(pre)
         if build is not None:
             s += '+' + build
-        return s
+
+        setattr_ = object.__setattr__
+        setattr_(self, '_input', sv)
+        setattr_(self, '_raw', raw)
+        setattr_(self, 'prerelease', pre)
+        # a version without pre-release sorts after all of its pre-releases
+        setattr_(self, 'sort_key', nums + ((1, ()) if prerelease is None else (0, pre.key())))
+        setattr_(self, '_eq_key', nums + (prerelease, build))
+        setattr_(self, '_str', s)
+
+        if isinstance(sv, str):
+            if len(_interned) >= _INTERN_LIMIT:
+                _interned.clear()
+            _interned[sv] = self
+        return self
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Semver is immutable')
+
+    def __getitem__(self, key):
+        try:
+            return self._raw[Semver._FIELDS.index(key)]
+        except ValueError:
+            raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return list(Semver._FIELDS)
+
+    def __str__(self):
+        return self._str
+
+    def __repr__(self):
+        return 'Semver(%r)' % (self._str)
 
     def __hash__(self):
-        return hash(str(self))
+        return hash(self._str)
+
+    def __reduce__(self):
+        return (Semver, (self._str,))
 
     def as_range(self):
         return SemverRange('=%s' % self)
 
     def parts(self):
-        major, minor, patch, prerelease, build = self.parts_raw()
-        if major is None:
-            major = '0'
-        if minor is None:
-            minor = '0'
-        if patch is None:
-            patch = '0'
-        return (int(major), int(minor), int(patch), prerelease, build)
+        return self._eq_key
 
     def parts_raw(self):
-        return (self['major'], self['minor'], self['patch'], self['prerelease'], self['build'])
+        return self._raw
 
     def __lt__(self, rhs):
-        lmaj, lmin, lpat, lpre, _ = self.parts()
-        rmaj, rmin, rpat, rpre, _ = rhs.parts()
-        if lmaj < rmaj:
-            return True
-        if lmaj > rmaj:
-            return False
-        if lmin < rmin:
-            return True
-        if lmin > rmin:
-            return False
-        if lpat < rpat:
-            return True
-        if lpat > rpat:
-            return False
-        if lpre is not None and rpre is None:
-            return True
-        if lpre is not None and rpre is not None:
-            if self.prerelease < rhs.prerelease:
-                return True
-        return False
+        return self.sort_key < rhs.sort_key
 
     def __le__(self, rhs):
         return not (self > rhs)
@@ -216,12 +217,14 @@ class Semver(dict):
 
     def __eq__(self, rhs):
         # build metadata is only considered for equality
-        lmaj, lmin, lpat, lpre, lbld = self.parts()
-        rmaj, rmin, rpat, rpre, rbld = rhs.parts()
-        return lmaj == rmaj and lmin == rmin and lpat == rpat and lpre == rpre and lbld == rbld
+        if not isinstance(rhs, Semver):
+            return NotImplemented
+        return self._eq_key == rhs._eq_key
 
     def __ne__(self, rhs):
-        return not (self == rhs)
+        if not isinstance(rhs, Semver):
+            return NotImplemented
+        return self._eq_key != rhs._eq_key
 
 
 class SemverRange(object):
@@ -237,23 +240,12 @@ class SemverRange(object):
         svs = [x.strip() for x in sv.split(',')]
 
         if len(svs) > 1:
+            # a comma-separated range is the intersection of its parts
             self._op = '^'
+            intervals = [_UNBOUNDED]
             for sr in svs:
-                rang = SemverRange(sr)
-                if rang.lower() is not None:
-                    if self._lower is None or rang.lower() < self._lower:
-                        self._lower = rang.lower()
-                if rang.upper() is not None:
-                    if self._upper is None or rang.upper() > self._upper:
-                        self._upper = rang.upper()
-                op, semver = rang.op_semver()
-                if semver is not None:
-                    if op == '>=':
-                        if self._lower is None or semver < self._lower:
-                            self._lower = semver
-                    if op == '<':
-                        if self._upper is None or semver > self._upper:
-                            self._upper = semver
+                intervals = _intersect(intervals, SemverRange(sr).intervals())
+            self._set_intervals(intervals)
             return
 
         match = SV_RANGE.match(sv)
@@ -387,50 +379,418 @@ class SemverRange(object):
             raise RuntimeError('No upper bound')
         self._upper = find_upper()
 
+        # compile to an interval of versions
+        if op in ('*', '^', '~'):
+            self._intervals = [(self._lower, True, self._upper, False)]
+        elif op == '<=':
+            self._intervals = [(None, True, self._semver, True)]
+        elif op == '<':
+            self._intervals = [(None, True, self._semver, False)]
+        elif op == '>=':
+            self._intervals = [(self._semver, True, None, False)]
+        elif op == '>':
+            self._intervals = [(self._semver, False, None, False)]
+        else:
+            self._intervals = [(self._semver, True, self._semver, True)]
+
+    @classmethod
+    def from_intervals(cls, intervals, description=None):
+        """
+        Build a range from (lower, lower_inclusive, upper, upper_inclusive)
+        tuples, where a None bound is unbounded
+        """
+        rang = cls.__new__(cls)
+        rang._input = description
+        rang._op = None
+        rang._semver = None
+        rang._set_intervals(intervals)
+        return rang
+
+    def _set_intervals(self, intervals):
+        self._intervals = _normalize(intervals)
+        self._lower = None
+        self._upper = None
+        if len(self._intervals) == 1:
+            self._lower, _, self._upper, _ = self._intervals[0]
+
+    def intervals(self):
+        """
+        The disjoint, sorted intervals of versions this range matches
+        """
+        return list(self._intervals)
+
+    def intersection(self, other):
+        return SemverRange.from_intervals(_intersect(self._intervals, other.intervals()),
+                                          '%s, %s' % (self, other))
+
+    def union(self, other):
+        return SemverRange.from_intervals(self._intervals + other.intervals(),
+                                          '%s || %s' % (self, other))
+
+    __and__ = intersection
+    __or__ = union
+
+    def filter(self, versions):
+        """
+        All versions in a VersionList (or iterable) matching this range,
+        in ascending order
+        """
+        versions = VersionList.of(versions)
+        out = []
+        for iv in self._intervals:
+            i, j = versions.span(iv)
+            out.extend(versions[i:j])
+        edge = self._build_edge()
+        if edge is not None:
+            # the intervals ignore build metadata; re-check the
+            # versions sharing the bound's sort_key with compare()
+            i, j = versions.span((edge, True, edge, True))
+            key = edge.sort_key
+            out = [v for v in out if v.sort_key < key] + \
+                [v for v in versions[i:j] if self.compare(v)] + \
+                [v for v in out if v.sort_key > key]
+        return out
+
+    def max_satisfying(self, versions):
+        """
+        The highest version in a VersionList (or iterable) matching
+        this range, or None
+        """
+        versions = VersionList.of(versions)
+        if self._build_edge() is not None:
+            matches = self.filter(versions)
+            return matches[-1] if matches else None
+        for iv in reversed(self._intervals):
+            i, j = versions.span(iv)
+            if i < j:
+                return versions[j - 1]
+        return None
+
+    def min_satisfying(self, versions):
+        """
+        The lowest version in a VersionList (or iterable) matching
+        this range, or None
+        """
+        versions = VersionList.of(versions)
+        if self._build_edge() is not None:
+            matches = self.filter(versions)
+            return matches[0] if matches else None
+        for iv in self._intervals:
+            i, j = versions.span(iv)
+            if i < j:
+                return versions[i]
+        return None
+
     def __repr__(self):
         return "SemverRange(%s, op=%s, semver=%s, lower=%s, upper=%s)" % (repr(self._input), self._op, self._semver, self._lower, self._upper)
 
     def __str__(self):
         return self._input
 
+    def _check_bounds(self):
+        if len(self._intervals) != 1:
+            raise ValueError('%s is empty or not one interval, use intervals()' % self)
+
     def lower(self):
+        """
+        The lower bound of the range, or None if it has none
+        Raises ValueError for an empty range or a union of
+        disjoint intervals, which have no single bound
+        """
+        self._check_bounds()
         return self._lower
 
     def upper(self):
+        """
+        The upper bound of the range, or None if it has none
+        Raises ValueError like lower()
+        """
+        self._check_bounds()
         return self._upper
 
     def op_semver(self):
         return self._op, self._semver
 
+    def _build_edge(self):
+        # =, > and <= compare build metadata like Semver's own
+        # operators: =1.0.0 and <=1.0.0 reject 1.0.0+build, and
+        # >1.0.0 accepts it. Returns the bound they apply to, or None
+        if self._op in ('=', '>', '<=') and self._semver is not None:
+            return self._semver
+        return None
+
     def compare(self, sv):
         if not isinstance(sv, Semver):
             sv = Semver(sv)
+        edge = self._build_edge()
+        if edge is not None and sv.sort_key == edge.sort_key:
+            return sv != edge if self._op == '>' else sv == edge
+        key = sv.sort_key
+        for iv in self._intervals:
+            if _contains(iv, key):
+                return True
+        return False
 
-        op = self._op
-        if op == '*':
-            if self._semver is not None and self._semver['major'] == '*':
-                return sv >= Semver('0.0.0')
-            if self._lower is not None and sv < self._lower:
-                return False
-            if self._upper is not None and sv >= self._upper:
-                return False
-            return True
-        elif op == '^':
-            return (sv >= self._lower) and (sv < self._upper)
-        elif op == '~':
-            return (sv >= self._lower) and (sv < self._upper)
-        elif op == '<=':
-            return sv <= self._semver
-        elif op == '>=':
-            return sv >= self._semver
-        elif op == '<':
-            return sv < self._semver
-        elif op == '>':
-            return sv > self._semver
-        elif op == '=':
-            return sv == self._semver
 
-        raise RuntimeError('Semver comparison failed to find a matching op')
+# intervals are (lower, lower_inclusive, upper, upper_inclusive),
+# compared by sort_key, so build metadata is ignored when matching
+# them; only a plain =, > or <= requirement looks at it
+_UNBOUNDED = (None, True, None, False)
+
+
+def _contains(iv, key):
+    lower, linc, upper, uinc = iv
+    if lower is not None:
+        lk = lower.sort_key
+        if key < lk or (key == lk and not linc):
+            return False
+    if upper is not None:
+        uk = upper.sort_key
+        if key > uk or (key == uk and not uinc):
+            return False
+    return True
+
+
+def _empty(iv):
+    lower, linc, upper, uinc = iv
+    if lower is None or upper is None:
+        return False
+    if lower.sort_key > upper.sort_key:
+        return True
+    return lower.sort_key == upper.sort_key and not (linc and uinc)
+
+
+def _lower_key(iv):
+    # sorts unbounded first, and inclusive before exclusive
+    lower, linc, _, _ = iv
+    if lower is None:
+        return (0,)
+    return (1, lower.sort_key, 0 if linc else 1)
+
+
+def _max_upper(a, b):
+    # the higher of two upper bounds, preferring inclusive
+    if a[0] is None or b[0] is None:
+        return (None, False)
+    if a[0].sort_key != b[0].sort_key:
+        return a if a[0].sort_key > b[0].sort_key else b
+    return (a[0], a[1] or b[1])
+
+
+def _normalize(intervals):
+    """
+    Sort intervals and merge the ones that overlap or touch
+    """
+    out = []
+    for iv in sorted((iv for iv in intervals if not _empty(iv)), key=_lower_key):
+        if out:
+            plower, plinc, pupper, puinc = out[-1]
+            lower, linc, upper, uinc = iv
+            touches = pupper is None or lower is None or \
+                lower.sort_key < pupper.sort_key or \
+                (lower.sort_key == pupper.sort_key and (linc or puinc))
+            if touches:
+                upper, uinc = _max_upper((pupper, puinc), (upper, uinc))
+                out[-1] = (plower, plinc, upper, uinc)
+                continue
+        out.append(iv)
+    return out
+
+
+def _intersect(xs, ys):
+    out = []
+    for lower1, linc1, upper1, uinc1 in xs:
+        for lower2, linc2, upper2, uinc2 in ys:
+            # the higher lower bound, preferring exclusive
+            if lower1 is None:
+                lower, linc = lower2, linc2
+            elif lower2 is None or lower1.sort_key > lower2.sort_key:
+                lower, linc = lower1, linc1
+            elif lower1.sort_key < lower2.sort_key:
+                lower, linc = lower2, linc2
+            else:
+                lower, linc = lower1, linc1 and linc2
+            # the lower upper bound, preferring exclusive
+            if upper1 is None:
+                upper, uinc = upper2, uinc2
+            elif upper2 is None or upper1.sort_key < upper2.sort_key:
+                upper, uinc = upper1, uinc1
+            elif upper1.sort_key > upper2.sort_key:
+                upper, uinc = upper2, uinc2
+            else:
+                upper, uinc = upper1, uinc1 and uinc2
+            out.append((lower, linc, upper, uinc))
+    return _normalize(out)
+
+
+class VersionList(object):
+    """
+    Versions sorted once, for O(log n) range queries
+    """
+    def __init__(self, versions):
+        self._versions = sorted((Semver(v) for v in versions), key=lambda v: v.sort_key)
+        self._keys = [v.sort_key for v in self._versions]
+
+    @staticmethod
+    def of(versions):
+        if isinstance(versions, VersionList):
+            return versions
+        return VersionList(versions)
+
+    def __len__(self):
+        return len(self._versions)
+
+    def __getitem__(self, i):
+        return self._versions[i]
+
+    def __iter__(self):
+        return iter(self._versions)
+
+    def span(self, iv):
+        """
+        Return (i, j) so that self[i:j] are the versions in interval iv
+        """
+        lower, linc, upper, uinc = iv
+        if lower is None:
+            i = 0
+        elif linc:
+            i = bisect.bisect_left(self._keys, lower.sort_key)
+        else:
+            i = bisect.bisect_right(self._keys, lower.sort_key)
+        if upper is None:
+            j = len(self._keys)
+        elif uinc:
+            j = bisect.bisect_right(self._keys, upper.sort_key)
+        else:
+            j = bisect.bisect_left(self._keys, upper.sort_key)
+        return i, max(i, j)
+
+
+class PackedVersions(object):
+    """
+    Versions packed as an array of integer ranks for batch range
+    matching: equal versions (ignoring build metadata) share a rank,
+    and ranks follow sort_key order, so every SemverRange becomes a
+    few contiguous rank slices
+    """
+    def __init__(self, versions):
+        self.versions = [v if isinstance(v, Semver) else Semver(v) for v in versions]
+        keys = sorted(set(v.sort_key for v in self.versions))
+        rank_of = dict((k, r) for r, k in enumerate(keys))
+        self.keys = keys
+        self.ranks = array('l', [rank_of[v.sort_key] for v in self.versions])
+        # column indices in ascending version order, and where each
+        # rank starts in it
+        self.order = array('l', sorted(range(len(self.versions)), key=self.ranks.__getitem__))
+        sorted_ranks = [self.ranks[i] for i in self.order]
+        self.starts = array('l', [bisect.bisect_left(sorted_ranks, r) for r in range(len(keys) + 1)])
+
+    def __len__(self):
+        return len(self.versions)
+
+    def rank_slices(self, rang):
+        """
+        The (start, stop) rank slices matched by rang
+        """
+        if not isinstance(rang, SemverRange):
+            rang = semver_range(rang)
+        slices = []
+        for lower, linc, upper, uinc in rang.intervals():
+            if lower is None:
+                lo = 0
+            elif linc:
+                lo = bisect.bisect_left(self.keys, lower.sort_key)
+            else:
+                lo = bisect.bisect_right(self.keys, lower.sort_key)
+            if upper is None:
+                hi = len(self.keys)
+            elif uinc:
+                hi = bisect.bisect_right(self.keys, upper.sort_key)
+            else:
+                hi = bisect.bisect_left(self.keys, upper.sort_key)
+            if lo < hi:
+                slices.append((lo, hi))
+        return slices
+
+
+_range_memo = {}
+
+
+def semver_range(req):
+    """
+    Parse req, remembering the result for repeated requirements
+    """
+    r = _range_memo.get(req)
+    if r is None:
+        if len(_range_memo) >= _INTERN_LIMIT:
+            _range_memo.clear()
+        r = _range_memo[req] = SemverRange(req)
+    return r
+
+
+def _edge_rank(versions, rang):
+    # ranks ignore build metadata, which a plain =, > or <=
+    # requirement still compares; returns the rank whose versions
+    # must be re-checked with rang.compare(), or None
+    edge = rang._build_edge()
+    if edge is None:
+        return None
+    r = bisect.bisect_left(versions.keys, edge.sort_key)
+    if r < len(versions.keys) and versions.keys[r] == edge.sort_key:
+        return r
+    return None
+
+
+def match_matrix(ranges, versions):
+    """
+    Evaluate every range against every version. Returns one
+    bytearray per range with a 1 for each matching version,
+    in the order versions were given
+    versions: a PackedVersions, or anything it accepts
+    """
+    if not isinstance(versions, PackedVersions):
+        versions = PackedVersions(versions)
+    nranks = len(versions.keys)
+    ranks = versions.ranks
+    matrix = []
+    for rang in ranges:
+        rang = semver_range(rang) if not isinstance(rang, SemverRange) else rang
+        by_rank = bytearray(nranks)
+        for lo, hi in versions.rank_slices(rang):
+            by_rank[lo:hi] = b'\x01' * (hi - lo)
+        row = bytearray(map(by_rank.__getitem__, ranks))
+        r = _edge_rank(versions, rang)
+        if r is not None:
+            for i in versions.order[versions.starts[r]:versions.starts[r + 1]]:
+                row[i] = rang.compare(versions.versions[i])
+        matrix.append(row)
+    return matrix
+
+
+def match_indices(ranges, versions):
+    """
+    Evaluate every range against every version. Returns one list
+    per range of the indices of its matching versions, in ascending
+    version order
+    versions: a PackedVersions, or anything it accepts
+    """
+    if not isinstance(versions, PackedVersions):
+        versions = PackedVersions(versions)
+    order, starts = versions.order, versions.starts
+    result = []
+    for rang in ranges:
+        rang = semver_range(rang) if not isinstance(rang, SemverRange) else rang
+        indices = []
+        for lo, hi in versions.rank_slices(rang):
+            indices.extend(order[starts[lo]:starts[hi]])
+        r = _edge_rank(versions, rang)
+        if r is not None:
+            ranks = versions.ranks
+            edge = [i for i in order[starts[r]:starts[r + 1]] if rang.compare(versions.versions[i])]
+            indices = [i for i in indices if ranks[i] < r] + edge + \
+                [i for i in indices if ranks[i] > r]
+        result.append(indices)
+    return result
 
 
 def test_semver():
@@ -512,3 +872,128 @@ def test_semver_range():
 def test_semver_multirange():
     assert SemverRange(">= 0.5, < 2.0").compare("1.0.0")
     assert SemverRange("*").compare("0.2.7")
+    assert not SemverRange(">= 0.5, < 2.0").compare("2.0.0")
+    assert SemverRange("> 0.5, <= 2.0").compare("2.0.0")
+    assert not SemverRange("> 0.5, <= 2.0").compare("0.5.0")
+    assert not SemverRange("^1.2, ^2.0").compare("1.5.0")
+
+
+def test_semver_range_sets():
+    r = SemverRange("^1.2.0") & SemverRange("<1.5")
+    assert (r.lower(), r.upper()) == (Semver("1.2.0"), Semver("1.5.0"))
+    u = SemverRange("^0.1") | SemverRange("^0.2")
+    assert len(u.intervals()) == 1 and u.compare("0.2.9") and not u.compare("0.3.0")
+    assert len((SemverRange("^0.1") | SemverRange("^0.3")).intervals()) == 2
+    assert (SemverRange("<1") & SemverRange(">=2")).intervals() == []
+    for r in (SemverRange("^1, ^2"), SemverRange("^0.1") | SemverRange("^0.3")):
+        try:
+            r.lower()
+            assert False
+        except ValueError:
+            pass
+
+    versions = VersionList(["0.1.0", "1.3.0", "1.2.0", "2.1.0-alpha", "1.9.9", "2.0.0", "0.9.0"])
+    assert [str(v) for v in SemverRange("^1.2.0").filter(versions)] == ["1.2.0", "1.3.0", "1.9.9"]
+    assert str(SemverRange("^1.2.0").max_satisfying(versions)) == "1.9.9"
+    assert str(SemverRange("^1.2.0").min_satisfying(versions)) == "1.2.0"
+    assert str(SemverRange(">2.0.0").min_satisfying(versions)) == "2.1.0-alpha"
+    assert str(SemverRange("=2.0.0").max_satisfying(["2.0.0", "1.0.0"])) == "2.0.0"
+    # = compares build metadata, as it always has
+    assert not SemverRange("=2.0.0").compare("2.0.0+build")
+    assert SemverRange("=2.0.0+build").compare("2.0.0+build")
+    assert SemverRange("=2.0.0").max_satisfying(["2.0.0+build"]) is None
+    assert [str(v) for v in SemverRange("=2.0.0+b").filter(["2.0.0+a", "2.0.0+b"])] == ["2.0.0+b"]
+    # so do > and <=, matching Semver's own > and <= operators
+    assert SemverRange(">1.0.0").compare("1.0.0+build")
+    assert not SemverRange(">1.0.0").compare("1.0.0")
+    assert not SemverRange("<=1.0.0").compare("1.0.0+build")
+    assert SemverRange("<=1.0.0").compare("1.0.0")
+    ops = {'>': lambda a, b: a > b, '<=': lambda a, b: a <= b,
+           '>=': lambda a, b: a >= b, '<': lambda a, b: a < b}
+    for op, cmp in ops.items():
+        for v in ("1.0.0", "1.0.0+build", "0.9.0", "1.0.1"):
+            assert SemverRange(op + "1.0.0").compare(v) == cmp(Semver(v), Semver("1.0.0"))
+    built = ["0.9.0", "1.0.0", "1.0.0+build", "1.0.1"]
+    assert [str(v) for v in SemverRange(">1.0.0").filter(built)] == ["1.0.0+build", "1.0.1"]
+    assert [str(v) for v in SemverRange("<=1.0.0").filter(built)] == ["0.9.0", "1.0.0"]
+    assert str(SemverRange(">1.0.0").min_satisfying(built)) == "1.0.0+build"
+    assert str(SemverRange("<=1.0.0").max_satisfying(built)) == "1.0.0"
+    assert SemverRange("^3").max_satisfying(versions) is None
+    assert str((SemverRange("^0.1") | SemverRange("^1")).max_satisfying(versions)) == "1.9.9"
+
+
+def test_semver_interned():
+    assert Semver("1.2.3") is Semver("1.2.3")
+    assert Semver(Semver("1.2.3")) is Semver("1.2.3")
+    assert Semver("1.2")['patch'] is None
+    try:
+        Semver("1.2.3").major = 2
+        assert False, 'Semver should be immutable'
+    except AttributeError:
+        pass
+    versions = ["1.0.0", "1.0.0-alpha", "1.0.0-alpha.1", "1.0.0-beta", "0.9.9", "1.0.0-1"]
+    by_key = sorted((Semver(v) for v in versions), key=lambda v: v.sort_key)
+    assert [str(v) for v in by_key] == ["0.9.9", "1.0.0-1", "1.0.0-alpha", "1.0.0-beta",
+                                        "1.0.0-alpha.1", "1.0.0"]
+    for a in by_key:
+        for b in by_key:
+            assert (a < b) == (a.sort_key < b.sort_key)
+
+
+def test_semver_batch():
+    versions = ["1.0.0", "0.1.0", "1.0.0-alpha", "1.0.0+build", "1.0.0-alpha.1",
+                "1.0.0-beta", "1.0.0-alpha.beta", "1.0.0-rc.1", "2.0.0", "1.0.0-beta.11",
+                "1.0.0-beta.2"]
+    ranges = ["^1.0.0", ">1.0.0-alpha", "<1.0.0", "=1.0.0", "=1.0.0+build", "*", "^0.1, <0.1.0",
+              ">1.0.0", "<=1.0.0", ">1.0.0+build", "<=1.0.0+build"]
+    packed = PackedVersions(versions)
+    matrix = match_matrix(ranges, packed)
+    indices = match_indices(ranges, packed)
+    for r, row, idx in zip(ranges, matrix, indices):
+        expected = [SemverRange(r).compare(v) for v in versions]
+        assert [bool(x) for x in row] == expected
+        assert sorted(idx) == [i for i, m in enumerate(expected) if m]
+        assert [packed.versions[i] for i in idx] == sorted(packed.versions[i] for i in idx)
+    assert packed.ranks[0] == packed.ranks[3]
+    assert match_indices([SemverRange("^0.1") | SemverRange("^2")], versions) == [[1, 8]]
+
+
+def benchmark(n=50000):
+    """
+    Print parse, sort and compare throughput
+    Run with: python -m cargoapi.semver
+    """
+    rnd = random.Random(0)
+    strings = []
+    for _ in range(n):
+        v = '%d.%d.%d' % (rnd.randint(0, 3), rnd.randint(0, 30), rnd.randint(0, 30))
+        if rnd.random() < 0.1:
+            v += '-%s.%d' % (rnd.choice(['alpha', 'beta', 'rc']), rnd.randint(0, 5))
+        strings.append(v)
+
+    def rate(label, count, fn):
+        start = time.time()
+        fn()
+        elapsed = time.time() - start
+        print('%-24s %10.0f/s' % (label, count / elapsed if elapsed else float('inf')))
+
+    _interned.clear()
+    rate('parse (cold)', n, lambda: [Semver(v) for v in strings])
+    rate('parse (interned)', n, lambda: [Semver(v) for v in strings])
+    versions = [Semver(v) for v in strings]
+    pairs = list(zip(versions, versions[1:]))
+    rate('compare (<)', len(pairs), lambda: [a < b for a, b in pairs])
+    rate('compare (==)', len(pairs), lambda: [a == b for a, b in pairs])
+    rate('sort (elements)', n, lambda: sorted(versions))
+    rate('sort by key (elements)', n, lambda: sorted(versions, key=lambda v: v.sort_key))
+    reqs = ['^%d.%d' % (rnd.randint(0, 3), rnd.randint(0, 30)) for _ in range(200)]
+    sample = versions[:5000]
+    ranges = [semver_range(r) for r in reqs]
+    rate('range compare (pairs)', len(reqs) * len(sample),
+         lambda: [[r.compare(v) for v in sample] for r in ranges])
+    packed = PackedVersions(sample)
+    rate('match_matrix (pairs)', len(reqs) * len(sample), lambda: match_matrix(reqs, packed))
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,209 @@
+# cargoapi.snapshot
+# single-file compressed snapshot of a registry index
+#
+# A checkout of the crates.io index is hundreds of thousands of
+# small files. A snapshot packs it into one file: each crate's
+# index file is compressed on its own, followed by a table of
+# crate names sorted for binary search. Readers mmap the snapshot
+# and only decompress the crates they look up.
+#
+# Layout:
+#   header   magic, crate count, table offset, names offset
+#   blocks   zlib compressed index files
+#   table    (name offset, name length, block offset, block length)
+#   names    the crate names, in table order
+
+import os
+import mmap
+import zlib
+import shutil
+import struct
+import tempfile
+from . import index_for_crate, index_files
+
+_MAGIC = b'CIS1'
+_HEADER = struct.Struct('<4sIQQ')
+_RECORD = struct.Struct('<IHQI')
+
+
+class SnapshotWriter(object):
+    """
+    Write a snapshot to path; blocks may be added in any order
+    """
+    def __init__(self, path, level=9):
+        self.path = path
+        self.level = level
+        self._table = []
+        self._fd, self._tmpname = tempfile.mkstemp(prefix='.%s.' % os.path.basename(path),
+                                                   dir=os.path.dirname(path) or '.')
+        self._f = os.fdopen(self._fd, 'wb')
+        self._f.write(b'\0' * _HEADER.size)
+        self._offset = _HEADER.size
+
+    def add(self, name, data):
+        """
+        Add the contents of a crate's index file
+        """
+        self.add_compressed(name, zlib.compress(data, self.level))
+
+    def add_compressed(self, name, block):
+        """
+        Add a block as returned by Snapshot.block()
+        """
+        self._f.write(block)
+        self._table.append((name.encode('utf-8'), self._offset, len(block)))
+        self._offset += len(block)
+
+    def close(self):
+        try:
+            self._table.sort()
+            names_offset = self._offset + _RECORD.size * len(self._table)
+            koff = names_offset
+            for name, off, ln in self._table:
+                self._f.write(_RECORD.pack(koff, len(name), off, ln))
+                koff += len(name)
+            for name, off, ln in self._table:
+                self._f.write(name)
+            self._f.seek(0)
+            self._f.write(_HEADER.pack(_MAGIC, len(self._table), self._offset, names_offset))
+            self._f.close()
+            os.chmod(self._tmpname, 0o644)
+            os.rename(self._tmpname, self.path)
+        except BaseException:
+            self.abort()
+            raise
+
+    def abort(self):
+        if not self._f.closed:
+            self._f.close()
+        if os.path.exists(self._tmpname):
+            os.unlink(self._tmpname)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def build(root, path, level=9):
+    """
+    Pack the index checkout at root into a snapshot at path
+    Returns the number of crates written
+    """
+    count = 0
+    with SnapshotWriter(path, level) as w:
+        for name, p in index_files(root):
+            with open(p, 'rb') as f:
+                w.add(name, f.read())
+            count += 1
+    return count
+
+
+class Snapshot(object):
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, self._table, self._names = _HEADER.unpack_from(self._map, 0)
+        if magic != _MAGIC:
+            self._map.close()
+            raise ValueError("%s is not an index snapshot" % (path))
+
+    def close(self):
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def _record(self, i):
+        koff, klen, off, ln = _RECORD.unpack_from(self._map, self._table + i * _RECORD.size)
+        return self._map[koff:koff + klen], off, ln
+
+    def _find(self, name):
+        key = name.lower().encode('utf-8')
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            k, off, ln = self._record(mid)
+            if k < key:
+                lo = mid + 1
+            elif k > key:
+                hi = mid
+            else:
+                return off, ln
+        return None
+
+    def __contains__(self, name):
+        return self._find(name) is not None
+
+    def names(self):
+        return [self._record(i)[0].decode('utf-8') for i in range(self.count)]
+
+    def block(self, name):
+        """
+        The compressed block for name, or None
+        """
+        pos = self._find(name)
+        if pos is None:
+            return None
+        return self._map[pos[0]:pos[0] + pos[1]]
+
+    def get(self, name):
+        """
+        The index file contents for name, or None
+        """
+        block = self.block(name)
+        if block is None:
+            return None
+        return zlib.decompress(block)
+
+
+def test_snapshot():
+    import cargoapi
+    root = tempfile.mkdtemp()
+    try:
+        index = os.path.join(root, 'index')
+        crates = {'a': b'{"name":"a","vers":"1.0.0"}\n', 'serde': b'{"name":"serde","vers":"1.0.0"}\n',
+                  'abc': b'{"name":"abc","vers":"0.1.0"}\n{"name":"abc","vers":"0.2.0"}\n'}
+        for name, data in crates.items():
+            cargoapi.write_index(index_for_crate(index, name), [data.decode('utf-8')])
+        with open(os.path.join(index, 'config.json'), 'w') as f:
+            f.write('{}')
+        path = os.path.join(root, 'index.snapshot')
+        assert build(index, path) == 3
+        with Snapshot(path) as snap:
+            assert snap.names() == ['a', 'abc', 'serde']
+            assert snap.get('abc') == crates['abc'] and snap.get('Serde') == crates['serde']
+            assert snap.get('nope') is None and 'a' in snap
+
+            class Source(object):
+                # the live index, with a release newer than the snapshot
+                fetched = []
+
+                def fetch(self, name):
+                    self.fetched.append(name)
+                    return crates[name] + b'{"name":"serde","vers":"1.0.1","cksum":"new"}\n'
+
+            cargoapi.set_index_snapshot(snap)
+            cargoapi.set_index_source(Source())
+            try:
+                assert cargoapi.fetch_index_entry('serde') == crates['serde']
+                assert cargoapi.fetch_index_entry('serde', ['1.0.0']) == crates['serde']
+                assert Source.fetched == []
+                assert cargoapi.index_cksum('serde', '1.0.1') == 'new'
+                assert Source.fetched == ['serde']
+            finally:
+                cargoapi.set_index_snapshot(None)
+                cargoapi.set_index_source(None)
+    finally:
+        shutil.rmtree(root)
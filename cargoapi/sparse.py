@@ -0,0 +1,209 @@
+# cargoapi.sparse
+# client for the sparse HTTP registry index
+#
+# The sparse protocol serves each crate's index file over plain
+# HTTP under the same layout as the git index. Files are fetched
+# concurrently over the per-thread pooled sessions and, with an
+# HTTPCache configured, revalidated with their ETags. The dependency
+# closure of a Cargo.lock is walked breadth first, so that every
+# crate in one level of the graph is requested at once.
+
+import os
+import re
+import json
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent import futures
+import requests
+from . import index_for_crate, session, http_cache
+
+SPARSE_URL = 'https://index.crates.io'
+
+LOCKDEP = re.compile(r'(\S+)(?:\s+(\S+))?(?:\s+\((.+)\))?')
+
+
+class SparseIndex(object):
+    def __init__(self, url=SPARSE_URL, jobs=16):
+        self.url = url.rstrip('/')
+        self.jobs = jobs
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def file_url(self, name):
+        return index_for_crate(self.url, name.lower())
+
+    def fetch(self, name):
+        """
+        Return the index file of the crate name
+        """
+        url = self.file_url(name)
+        with self._lock:
+            self.requests += 1
+        cache = http_cache()
+        if cache is not None:
+            return cache.get(session(), url)[0]
+        r = session().get(url)
+        r.raise_for_status()
+        return r.content
+
+    def _fetch_or_none(self, name):
+        try:
+            return self.fetch(name)
+        except requests.HTTPError as e:
+            if e.response is not None and e.response.status_code in (404, 410):
+                return None
+            raise
+
+    def fetch_many(self, names):
+        """
+        Fetch the index files of many crates concurrently
+        Returns {name: contents, or None if there is no such crate}
+        """
+        names = list(OrderedDict.fromkeys(names))
+        if self.jobs <= 1 or len(names) <= 1:
+            return OrderedDict((n, self._fetch_or_none(n)) for n in names)
+        with futures.ThreadPoolExecutor(max_workers=min(self.jobs, len(names))) as pool:
+            return OrderedDict(zip(names, pool.map(self._fetch_or_none, names)))
+
+
+def lock_closure(index, lock):
+    """
+    Fetch the index entries of every registry package a Cargo.lock
+    depends on, one level of the dependency graph at a time
+    Returns an OrderedDict of (name, version) -> index entry, in
+    breadth first order
+    """
+    packages = lock.get('package', [])
+    if 'root' in lock:
+        packages = [lock['root']] + packages
+    locks = OrderedDict(((p['name'], p['version']), p) for p in packages)
+    versions = {}
+    for name, version in locks:
+        versions.setdefault(name, []).append(version)
+
+    if 'root' in lock:
+        level = [(lock['root']['name'], lock['root']['version'])]
+    else:
+        level = [k for k, p in locks.items() if 'source' not in p]
+    seen = set(level)
+    files = {}
+    entries = OrderedDict()
+    while level:
+        wanted = [name for name, version in level
+                  if locks[(name, version)].get('source', '').startswith('registry+') and name not in files]
+        files.update(index.fetch_many(wanted))
+        following = []
+        for key in level:
+            data = files.get(key[0])
+            if data is not None and locks[key].get('source', '').startswith('registry+'):
+                for line in data.decode('utf-8').splitlines():
+                    if line.strip():
+                        e = json.loads(line)
+                        if e['vers'] == key[1]:
+                            entries[key] = e
+                            break
+            for dep in locks[key].get('dependencies', []):
+                m = LOCKDEP.match(dep)
+                name, version = m.group(1), m.group(2)
+                if version is None:
+                    # newer lockfiles leave out unambiguous versions
+                    version = versions.get(name, [None])[0]
+                dkey = (name, version)
+                if dkey in locks and dkey not in seen:
+                    seen.add(dkey)
+                    following.append(dkey)
+        level = following
+    return entries
+
+
+def _serve(root):
+    """
+    Serve root over HTTP with ETags; returns (server, base url)
+    """
+    import hashlib
+    from http.server import HTTPServer, SimpleHTTPRequestHandler
+
+    class Handler(SimpleHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            p = os.path.join(root, self.path.lstrip('/'))
+            if not os.path.isfile(p):
+                self.send_error(404)
+                return
+            with open(p, 'rb') as f:
+                data = f.read()
+            etag = '"%s"' % hashlib.sha256(data).hexdigest()[:16]
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    return server, 'http://127.0.0.1:%d' % (server.server_address[1])
+
+
+def test_sparse():
+    import cargoapi
+    from .httpcache import HTTPCache
+    from . import write_index
+    root = tempfile.mkdtemp()
+    server = None
+    try:
+        index = os.path.join(root, 'index')
+
+        def publish(name, vers, deps=()):
+            write_index(index_for_crate(index, name), [json.dumps(
+                {'name': name, 'vers': v, 'cksum': '%s-%s' % (name, v),
+                 'deps': [{'name': d, 'req': '*'} for d in deps]}) + '\n' for v in vers])
+
+        publish('a', ['1.0.0'], ['bcd'])
+        publish('bcd', ['0.1.0', '0.2.0'], ['efgh'])
+        publish('efgh', ['2.0.0'])
+        publish('unused', ['1.0.0'])
+        server, url = _serve(index)
+
+        sparse = SparseIndex(url, jobs=4)
+        files = sparse.fetch_many(['a', 'bcd', 'missing'])
+        assert files['missing'] is None and b'"0.2.0"' in files['bcd']
+
+        reg = 'registry+https://github.com/rust-lang/crates.io-index'
+        lock = {'root': {'name': 'app', 'version': '0.1.0', 'dependencies': ['a 1.0.0 (%s)' % reg]},
+                'package': [
+                    {'name': 'a', 'version': '1.0.0', 'source': reg, 'dependencies': ['bcd']},
+                    {'name': 'bcd', 'version': '0.2.0', 'source': reg, 'dependencies': ['efgh 2.0.0']},
+                    {'name': 'efgh', 'version': '2.0.0', 'source': reg},
+                    {'name': 'unused', 'version': '1.0.0', 'source': reg}]}
+        sparse.requests = 0
+        entries = lock_closure(sparse, lock)
+        assert list(entries) == [('a', '1.0.0'), ('bcd', '0.2.0'), ('efgh', '2.0.0')]
+        assert entries[('bcd', '0.2.0')]['cksum'] == 'bcd-0.2.0'
+        assert sparse.requests == 3
+
+        cache = HTTPCache(os.path.join(root, 'cache'), ttl=0)
+        cargoapi.set_http_cache(cache)
+        cargoapi.set_index_source(sparse)
+        try:
+            assert cargoapi.index_cksum('efgh', '2.0.0') == 'efgh-2.0.0'
+            assert cargoapi.index_cksum('efgh', '2.0.0') == 'efgh-2.0.0'
+            assert cache.counters['misses'] == 1 and cache.counters['revalidated'] == 1
+        finally:
+            cargoapi.set_http_cache(None)
+            cargoapi.set_index_source(None)
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+        shutil.rmtree(root)
@@ -0,0 +1,161 @@
+# cargoapi.store
+# content-addressed store for .crate files, keyed by the
+# sha256 cksum from the registry index
+#
+# Project directories get hardlinks (or reflinks, or copies
+# as a last resort) into the store, so each crate is only
+# downloaded and kept on disk once per host.
+
+import os
+import errno
+import shutil
+import tempfile
+from . import cache_root, atomic_file, evict_lru
+
+_FICLONE = 0x40049409
+_DEFAULT_MAX_SIZE = 4 * 1024 * 1024 * 1024
+
+
+def default_root():
+    return cache_root('CARGO2RPM_STORE', 'crates')
+
+
+def _reflink(src, dst):
+    import fcntl
+    with open(src, 'rb') as s:
+        with open(dst, 'wb') as d:
+            fcntl.ioctl(d.fileno(), _FICLONE, s.fileno())
+
+
+def link_file(src, dst):
+    """
+    Make dst share the data of src
+    Tries a hardlink, then a reflink, then falls back to copying
+    """
+    try:
+        os.link(src, dst)
+        return
+    except OSError as e:
+        if e.errno == errno.EEXIST:
+            os.unlink(dst)
+            os.link(src, dst)
+            return
+    try:
+        _reflink(src, dst)
+        return
+    except (IOError, OSError, ImportError):
+        if os.path.exists(dst):
+            os.unlink(dst)
+    shutil.copyfile(src, dst)
+
+
+class CrateStore(object):
+    def __init__(self, root=None, max_size=_DEFAULT_MAX_SIZE):
+        self.root = os.path.abspath(root or default_root())
+        self.max_size = max_size
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+
+    def path(self, cksum):
+        return os.path.join(self.root, cksum[0:2], cksum[2:])
+
+    def has(self, cksum):
+        return os.path.isfile(self.path(cksum))
+
+    def touch(self, cksum):
+        """
+        Mark an entry as recently used
+        """
+        os.utime(self.path(cksum), None)
+
+    def prepare(self, cksum):
+        """
+        Return the path to store cksum at, creating its directory
+        """
+        p = self.path(cksum)
+        d = os.path.dirname(p)
+        if not os.path.isdir(d):
+            try:
+                os.makedirs(d)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        return p
+
+    def add(self, src, cksum):
+        """
+        Copy the file src into the store as cksum
+        The caller is responsible for having verified the checksum
+        """
+        p = self.prepare(cksum)
+        with atomic_file(p, prefix='.%s.' % (cksum), perms=0o644) as f:
+            with open(src, 'rb') as s:
+                shutil.copyfileobj(s, f)
+        return p
+
+    def link(self, cksum, dst):
+        """
+        Make dst a link to the stored crate for cksum
+        Returns False if the store doesn't have it
+        """
+        if not self.has(cksum):
+            return False
+        self.touch(cksum)
+        link_file(self.path(cksum), dst)
+        return True
+
+    def entries(self):
+        for d in os.listdir(self.root):
+            dp = os.path.join(self.root, d)
+            if len(d) != 2 or not os.path.isdir(dp):
+                continue
+            for f in os.listdir(dp):
+                # skip files still being written: downloads in
+                # progress, and copies by add() (tmp* from older runs)
+                if f.startswith('.') or f.startswith('tmp'):
+                    continue
+                yield os.path.join(dp, f)
+
+    def size(self):
+        return sum(os.path.getsize(p) for p in self.entries())
+
+    def gc(self, max_size=None):
+        """
+        Remove least recently used entries until the
+        store is no larger than max_size bytes
+        Returns the number of entries removed
+        """
+        if max_size is None:
+            max_size = self.max_size
+        if max_size is None:
+            return 0
+        removed, total = evict_lru(self.entries(), max_size=max_size)
+        return removed
+
+
+def test_store():
+    root = tempfile.mkdtemp()
+    try:
+        store = CrateStore(os.path.join(root, 'store'), max_size=None)
+        src = os.path.join(root, 'a.crate')
+        with open(src, 'wb') as f:
+            f.write(b'a' * 10)
+        assert not store.has('ab12')
+        store.add(src, 'ab12')
+        assert store.has('ab12')
+        dst = os.path.join(root, 'b.crate')
+        assert store.link('ab12', dst)
+        assert open(dst, 'rb').read() == b'a' * 10
+        assert not store.link('cd34', dst)
+        store.add(src, 'cd34')
+        os.utime(store.path('ab12'), (0, 0))
+        with open(os.path.join(os.path.dirname(store.path('cd34')), '.34.part'), 'wb') as f:
+            f.write(b'partial')
+        assert store.size() == 20
+        assert store.gc(15) == 1
+        assert not store.has('ab12')
+        assert store.has('cd34')
+        assert store.gc(0) == 1
+        assert os.listdir(os.path.dirname(store.path('cd34'))) == ['.34.part']
+    finally:
+        shutil.rmtree(root)
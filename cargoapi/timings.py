@@ -0,0 +1,219 @@
+# cargoapi.timings
+# build timings report for bootstrap builds
+#
+# Records every rustc and build script invocation with its wall
+# clock span, CPU time and peak RSS, and works out the critical
+# path through the crate dependency graph: the chain of crates
+# that determines how long the whole build takes.
+
+import os
+import json
+import time
+import threading
+
+try:
+    from html import escape
+except ImportError:
+    from cgi import escape
+
+
+class Timings(object):
+    def __init__(self):
+        self.start = time.time()
+        self.invocations = []
+        self.deps = {}
+        self._lock = threading.Lock()
+
+    def crate(self, namever, deps):
+        """
+        Register a crate and the crates it depends on
+        """
+        with self._lock:
+            self.deps[namever] = list(deps)
+
+    def record(self, namever, kind, runner):
+        """
+        Record a finished Runner invocation for a crate
+        """
+        with self._lock:
+            self.invocations.append({
+                'crate': namever,
+                'kind': kind,
+                'start': runner.started - self.start,
+                'end': runner.ended - self.start,
+                'cpu': runner.cpu,
+                'maxrss_kb': runner.maxrss,
+            })
+
+    def spans(self):
+        """
+        Return {namever: (start, end)} covering each crate's invocations
+        """
+        spans = {}
+        for inv in self.invocations:
+            s, e = spans.get(inv['crate'], (inv['start'], inv['end']))
+            spans[inv['crate']] = (min(s, inv['start']), max(e, inv['end']))
+        return spans
+
+    def critical_path(self):
+        """
+        Return the longest chain of crates through the dependency
+        graph, weighted by how long each crate took to build
+        """
+        spans = self.spans()
+        finish = {}
+        best = {}
+
+        def visit(nv):
+            if nv in finish:
+                return finish[nv]
+            finish[nv] = 0.0
+            s, e = spans.get(nv, (0.0, 0.0))
+            prev, longest = None, 0.0
+            for dep in self.deps.get(nv, []):
+                f = visit(dep)
+                if f > longest:
+                    prev, longest = dep, f
+            finish[nv] = longest + (e - s)
+            best[nv] = prev
+            return finish[nv]
+
+        end, total = None, 0.0
+        for nv in sorted(set(self.deps) | set(spans)):
+            f = visit(nv)
+            if f > total:
+                end, total = nv, f
+        path = []
+        while end is not None:
+            path.append(end)
+            end = best.get(end)
+        path.reverse()
+        return path, total
+
+    def report(self):
+        spans = self.spans()
+        path, total = self.critical_path()
+        crates = {}
+        for nv in sorted(set(self.deps) | set(spans)):
+            s, e = spans.get(nv, (None, None))
+            invs = [i for i in self.invocations if i['crate'] == nv]
+            crates[nv] = {
+                'start': s,
+                'end': e,
+                'duration': (e - s) if s is not None else 0.0,
+                'cpu': sum(i['cpu'] for i in invs),
+                'maxrss_kb': max([i['maxrss_kb'] for i in invs] or [0]),
+                'deps': self.deps.get(nv, []),
+            }
+        return {
+            'total': max([i['end'] for i in self.invocations] or [0.0]),
+            'invocations': sorted(self.invocations, key=lambda i: i['start']),
+            'crates': crates,
+            'critical_path': path,
+            'critical_path_time': total,
+        }
+
+    def write(self, out_dir):
+        """
+        Write cargo-timing.json and cargo-timing.html to out_dir
+        Returns the path of the html report
+        """
+        report = self.report()
+        with open(os.path.join(out_dir, 'cargo-timing.json'), 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        p = os.path.join(out_dir, 'cargo-timing.html')
+        with open(p, 'w') as f:
+            f.write(render_html(report))
+        return p
+
+
+_HTML = '''<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>cargo2rpm build timings</title>
+<style>
+body { font-family: sans-serif; font-size: 13px; }
+.row { position: relative; height: 18px; border-bottom: 1px solid #eee; }
+.label { position: absolute; left: 0; width: 240px; overflow: hidden; white-space: nowrap; }
+.lane { position: absolute; left: 250px; right: 0; top: 2px; bottom: 2px; }
+.bar { position: absolute; top: 0; bottom: 0; background: #7aa6da; }
+.bar.build-script { background: #e7c547; }
+.critical .label { font-weight: bold; }
+.critical .bar { background: #d54e53; }
+table { border-collapse: collapse; margin-top: 2em; }
+td, th { padding: 2px 8px; text-align: right; }
+td:first-child, th:first-child { text-align: left; }
+</style>
+</head>
+<body>
+<h1>Build timings</h1>
+<p>Total time: %(total).2fs. Critical path (%(cptime).2fs): %(path)s</p>
+%(rows)s
+<table>
+<tr><th>Crate</th><th>Time (s)</th><th>CPU (s)</th><th>Peak RSS (MiB)</th></tr>
+%(table)s
+</table>
+</body>
+</html>
+'''
+
+
+def render_html(report):
+    total = report['total'] or 1.0
+    critical = set(report['critical_path'])
+    crates = report['crates']
+    order = sorted(crates, key=lambda nv: (crates[nv]['start'] is None, crates[nv]['start'] or 0.0, nv))
+    rows = []
+    for nv in order:
+        bars = []
+        for inv in report['invocations']:
+            if inv['crate'] != nv:
+                continue
+            bars.append('<div class="bar %s" style="left:%.3f%%;width:%.3f%%" title="%s %.2fs"></div>' % (
+                escape(inv['kind']), 100.0 * inv['start'] / total,
+                max(0.1, 100.0 * (inv['end'] - inv['start']) / total),
+                escape(inv['kind']), inv['end'] - inv['start']))
+        rows.append('<div class="row%s"><div class="label">%s</div><div class="lane">%s</div></div>' % (
+            ' critical' if nv in critical else '', escape(nv), ''.join(bars)))
+    table = []
+    for nv in sorted(crates, key=lambda nv: -crates[nv]['duration']):
+        c = crates[nv]
+        table.append('<tr><td>%s</td><td>%.2f</td><td>%.2f</td><td>%.1f</td></tr>' % (
+            escape(nv), c['duration'], c['cpu'], c['maxrss_kb'] / 1024.0))
+    return _HTML % {
+        'total': report['total'],
+        'cptime': report['critical_path_time'],
+        'path': ' &rarr; '.join(escape(nv) for nv in report['critical_path']),
+        'rows': '\n'.join(rows),
+        'table': '\n'.join(table),
+    }
+
+
+class _FakeRunner(object):
+    def __init__(self, started, ended):
+        self.started = started
+        self.ended = ended
+        self.cpu = ended - started
+        self.maxrss = 1024
+
+
+def test_critical_path():
+    t = Timings()
+    t.start = 0.0
+    t.crate('app-1.0.0', ['a-1.0.0', 'b-1.0.0'])
+    t.crate('a-1.0.0', ['c-1.0.0'])
+    t.crate('b-1.0.0', ['c-1.0.0'])
+    t.crate('c-1.0.0', [])
+    t.crate('d-1.0.0', [])
+    t.record('c-1.0.0', 'rustc', _FakeRunner(0.0, 1.0))
+    t.record('a-1.0.0', 'build-script', _FakeRunner(1.0, 2.0))
+    t.record('a-1.0.0', 'rustc', _FakeRunner(2.0, 5.0))
+    t.record('b-1.0.0', 'rustc', _FakeRunner(1.0, 2.0))
+    t.record('app-1.0.0', 'rustc', _FakeRunner(5.0, 6.0))
+    path, total = t.critical_path()
+    assert path == ['c-1.0.0', 'a-1.0.0', 'app-1.0.0']
+    assert total == 6.0
+    report = t.report()
+    assert report['crates']['a-1.0.0']['duration'] == 4.0
+    assert 'a-1.0.0' in render_html(report)
@@ -0,0 +1,286 @@
+# cargoapi.versionindex
+# sidecar version -> byte offset index for registry index files
+#
+# Each index file may have a hidden sidecar next to it listing its
+# versions in sorted order along with the offset and length of each
+# version's line. Lookups bisect the sidecar through mmap instead of
+# parsing every line as JSON. The sidecar records the inode, size
+# and mtime of the index file it describes and is rebuilt whenever
+# those no longer match, or when its own length doesn't add up, as
+# after a crash left it partly written.
+
+import os
+import json
+import mmap
+import shutil
+import struct
+import tempfile
+from . import write_index, atomic_file
+
+_MAGIC = b'CVI1'
+# magic, inode, size, mtime (us), count
+_HEADER = struct.Struct('<4sQQQI')
+# key offset, key length, line offset, line length
+_RECORD = struct.Struct('<IHQI')
+
+
+def sidecar_path(indexfile):
+    d, f = os.path.split(indexfile)
+    return os.path.join(d, '.%s.vidx' % (f))
+
+
+def _stamp(st):
+    return (st.st_ino, st.st_size, int(st.st_mtime * 1000000))
+
+
+def scan(indexfile):
+    """
+    Return (version, offset, length) for every line of indexfile
+    """
+    entries = []
+    offset = 0
+    with open(indexfile, 'rb') as f:
+        for line in f:
+            if line.strip():
+                entries.append((json.loads(line.decode('utf-8'))['vers'], offset, len(line)))
+            offset += len(line)
+    return entries
+
+
+def write_sidecar(indexfile, entries):
+    """
+    Write the sidecar for indexfile from (version, offset, length)
+    entries, stamped with the current state of indexfile
+    """
+    entries = sorted((v.encode('utf-8'), off, ln) for v, off, ln in entries)
+    base = _HEADER.size + _RECORD.size * len(entries)
+    records = []
+    keys = []
+    koff = base
+    for key, off, ln in entries:
+        records.append(_RECORD.pack(koff, len(key), off, ln))
+        keys.append(key)
+        koff += len(key)
+    ino, size, mtime = _stamp(os.stat(indexfile))
+    data = _HEADER.pack(_MAGIC, ino, size, mtime, len(entries)) + b''.join(records) + b''.join(keys)
+    p = sidecar_path(indexfile)
+    with atomic_file(p, prefix='.vidx.', perms=0o644) as f:
+        f.write(data)
+
+
+def _length(m, count):
+    # the length a sidecar with count records should have: its
+    # keys follow the records in the same order, so the last key
+    # ends the file. None if the records don't fit
+    end = _HEADER.size + count * _RECORD.size
+    if len(m) < end:
+        return None
+    if count:
+        koff, klen, off, ln = _RECORD.unpack_from(m, end - _RECORD.size)
+        end = koff + klen
+    return end
+
+
+class VersionIndex(object):
+    """
+    Version lookups in one index file through its sidecar,
+    which is (re)built first if missing or stale
+    """
+    def __init__(self, indexfile):
+        self.indexfile = indexfile
+        self.rebuilt = False
+        self._map = None
+        if not self._open():
+            write_sidecar(indexfile, scan(indexfile))
+            self.rebuilt = True
+            if not self._open():
+                raise IOError("unable to index %s" % (indexfile))
+
+    def _open(self):
+        try:
+            with open(sidecar_path(self.indexfile), 'rb') as f:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError):
+            return False
+        if len(m) < _HEADER.size:
+            m.close()
+            return False
+        magic, ino, size, mtime, count = _HEADER.unpack_from(m, 0)
+        if magic != _MAGIC or (ino, size, mtime) != _stamp(os.stat(self.indexfile)) or \
+                _length(m, count) != len(m):
+            m.close()
+            return False
+        self._map = m
+        self.size = size
+        self.count = count
+        return True
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _record(self, i):
+        koff, klen, off, ln = _RECORD.unpack_from(self._map, _HEADER.size + i * _RECORD.size)
+        return self._map[koff:koff + klen], off, ln
+
+    def find(self, version):
+        """
+        Return the (offset, length) of version's line, or None
+        """
+        key = version.encode('utf-8')
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            k, off, ln = self._record(mid)
+            if k < key:
+                lo = mid + 1
+            elif k > key:
+                hi = mid
+            else:
+                return off, ln
+        return None
+
+    def entries(self):
+        result = []
+        for i in range(self.count):
+            k, off, ln = self._record(i)
+            result.append((k.decode('utf-8'), off, ln))
+        return result
+
+    def line(self, version):
+        """
+        The index line for version, or None
+        """
+        pos = self.find(version)
+        if pos is None:
+            return None
+        with open(self.indexfile, 'rb') as f:
+            f.seek(pos[0])
+            return f.read(pos[1]).decode('utf-8')
+
+
+def lookup(indexfile, version):
+    """
+    Return the index line for version in indexfile, or None
+    """
+    if not os.path.isfile(indexfile):
+        return None
+    with VersionIndex(indexfile) as vi:
+        return vi.line(version)
+
+
+def update(indexfile, version, entry):
+    """
+    update_crate through the sidecar: a new version is appended
+    in place, an existing one is replaced without parsing the
+    other lines
+    """
+    line = ('%s\n' % (entry)).encode('utf-8')
+    if not os.path.isfile(indexfile):
+        write_index(indexfile, ['%s\n' % (entry)])
+        write_sidecar(indexfile, [(version, 0, len(line))])
+        return
+    with VersionIndex(indexfile) as vi:
+        pos = vi.find(version)
+        entries = vi.entries()
+        size = vi.size
+    if pos is not None:
+        with open(indexfile, 'rb') as f:
+            data = f.read()
+        _splice(indexfile, data, entries, pos, line)
+        return
+    with open(indexfile, 'rb+') as f:
+        f.seek(max(0, size - 1))
+        if f.read(1) not in (b'', b'\n'):
+            # terminate the last line before appending after it
+            f.write(b'\n')
+            entries = [(v, o, l + 1 if o + l == size else l) for v, o, l in entries]
+            size += 1
+        f.write(line)
+    entries.append((version, size, len(line)))
+    write_sidecar(indexfile, entries)
+
+
+def remove(indexfile, version):
+    """
+    remove_crate through the sidecar
+    Returns True if version was in the index
+    """
+    if not os.path.isfile(indexfile):
+        return False
+    with VersionIndex(indexfile) as vi:
+        pos = vi.find(version)
+        entries = vi.entries()
+    if pos is None:
+        return False
+    with open(indexfile, 'rb') as f:
+        data = f.read()
+    _splice(indexfile, data, [e for e in entries if e[0] != version], pos, b'')
+    return True
+
+
+def _splice(indexfile, data, entries, pos, line):
+    # replace the line at pos, shifting the offsets that follow it
+    off, ln = pos
+    delta = len(line) - ln
+    write_index(indexfile, [(data[:off] + line + data[off + ln:]).decode('utf-8')])
+    shifted = []
+    for v, o, l in entries:
+        if o == off:
+            if line:
+                shifted.append((v, o, len(line)))
+        elif o > off:
+            shifted.append((v, o + delta, l))
+        else:
+            shifted.append((v, o, l))
+    write_sidecar(indexfile, shifted)
+
+
+def test_versionindex():
+    root = tempfile.mkdtemp()
+    try:
+        indexfile = os.path.join(root, 'serde')
+
+        def entry(v, extra=''):
+            return json.dumps({'name': 'serde', 'vers': v, 'x': extra}, sort_keys=True)
+
+        for v in ['1.0.0', '0.9.0', '1.0.10', '1.0.2']:
+            update(indexfile, v, entry(v))
+        with open(indexfile) as f:
+            assert [json.loads(l)['vers'] for l in f] == ['1.0.0', '0.9.0', '1.0.10', '1.0.2']
+        assert json.loads(lookup(indexfile, '1.0.10'))['vers'] == '1.0.10'
+        assert lookup(indexfile, '2.0.0') is None
+
+        update(indexfile, '0.9.0', entry('0.9.0', 'longer replacement'))
+        assert json.loads(lookup(indexfile, '0.9.0'))['x'] == 'longer replacement'
+        assert json.loads(lookup(indexfile, '1.0.2'))['vers'] == '1.0.2'
+        assert remove(indexfile, '1.0.0') and not remove(indexfile, '1.0.0')
+        assert json.loads(lookup(indexfile, '1.0.10'))['vers'] == '1.0.10'
+        with VersionIndex(indexfile) as vi:
+            assert not vi.rebuilt
+            assert sorted(vi.entries()) == sorted(scan(indexfile))
+
+        # a torn sidecar still carrying a matching stamp
+        with open(sidecar_path(indexfile), 'rb+') as f:
+            f.truncate(os.path.getsize(sidecar_path(indexfile)) - 3)
+        with VersionIndex(indexfile) as vi:
+            assert vi.rebuilt and sorted(vi.entries()) == sorted(scan(indexfile))
+
+        # edited behind the sidecar's back
+        write_index(indexfile, [entry('3.0.0')])
+        with VersionIndex(indexfile) as vi:
+            assert vi.rebuilt and [e[0] for e in vi.entries()] == ['3.0.0']
+        update(indexfile, '3.0.1', entry('3.0.1'))
+        with open(indexfile) as f:
+            assert [json.loads(l)['vers'] for l in f] == ['3.0.0', '3.0.1']
+        with VersionIndex(indexfile) as vi:
+            assert not vi.rebuilt and sorted(vi.entries()) == sorted(scan(indexfile))
+    finally:
+        shutil.rmtree(root)